@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""End to end benchmarks of the graphapi crawls.
+
+The crawls run against a local Simulator, so that they are repeatable
+and do not spend any API quota. graphapi needs the facebook tables of a
+web2py application, so the benchmarks run in its shell:
+
+    python web2py.py -S app -M -R applications/app/modules/benchmark.py \\
+        -A --members 1000 --posts 2000
+
+Benchmarks:
+
+    startup        time a new worker process takes to import graphapi
+    members        FcbGroup.get_members then set_members
+    feed           FcbGroup.get_feed then set_feed
+    filter_object  Base.filter_object of a user
+    update         Base.update of a user
+    db_update      Base.db_update of a user
+
+The other benchmarks report the objects processed per second, the
+requests sent per object, the p50/p99 request latency and the peak RSS
+of the process. Database changes are not committed (set_members and
+set_feed run with commit=False) and are rolled back after each
+benchmark. Results are appended to the --output JSON file, and compared
+with the previous run found in it so that regressions between versions
+are visible.
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+import facebook
+import graphapi
+import simulator
+
+BENCHMARKS = ("startup", "members", "feed", "filter_object", "update",
+              "db_update")
+
+
+class RequestRecorder(object):
+    """Request hook keeping the latency of every request."""
+    def __init__(self):
+        self.latencies = []
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, event, info):
+        with self._lock:
+            self.latencies.append(info["latency"])
+            if event == "request_error":
+                self.errors += 1
+
+    def percentile(self, percent):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        index = int(round(percent / 100.0 * (len(latencies) - 1)))
+        return latencies[index]
+
+
+def peak_rss():
+    """Returns the peak resident set size of the process, in kilobytes."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on Mac OS X, in kilobytes elsewhere
+    return rss / 1024 if sys.platform == "darwin" else rss
+
+
+def version():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(name, function, graph):
+    """Runs function(), which returns the number of objects processed."""
+    recorder = RequestRecorder()
+    graph.add_hook("request_end", recorder)
+    graph.add_hook("request_error", recorder)
+    started = time.time()
+    try:
+        objects = function()
+        elapsed = time.time() - started
+    finally:
+        graph.remove_hook("request_end", recorder)
+        graph.remove_hook("request_error", recorder)
+        graphapi.context.db.rollback()
+    requests = len(recorder.latencies)
+    return {
+        "objects": objects,
+        "seconds": elapsed,
+        "objects_per_second": objects / elapsed if elapsed else None,
+        "requests": requests,
+        "requests_per_object": requests / float(objects) if objects else None,
+        "errors": recorder.errors,
+        "latency_p50": recorder.percentile(50),
+        "latency_p99": recorder.percentile(99),
+        "peak_rss_kb": peak_rss(),
+    }
+
+
+def startup(runs=5):
+    """Measures the start of a worker importing graphapi.
+
+    Returns the median time spent importing graphapi and running the
+    whole process, over runs new Python processes.
+
+    """
+    code = ("import time; started = time.time(); import graphapi; "
+            "print time.time() - started")
+    directory = os.path.dirname(os.path.abspath(graphapi.__file__))
+    imports = []
+    processes = []
+    for i in range(runs):
+        started = time.time()
+        output = subprocess.check_output([sys.executable, "-c", code],
+                                         cwd=directory)
+        processes.append(time.time() - started)
+        imports.append(float(output))
+    return {
+        "import_seconds": sorted(imports)[runs // 2],
+        "process_seconds": sorted(processes)[runs // 2],
+        "runs": runs,
+    }
+
+
+def benchmarks(options, sim, graph):
+    """Returns the benchmark functions, by name."""
+    group_id = sim.dataset.group_id(0)
+    user_id = sim.dataset.user_id(1)
+    iterations = options.iterations
+
+    def members():
+        group = graphapi.FcbGroup(group_id, graph)
+        group.get_members()
+        group.set_members(commit=False)
+        return len(group.members) + 1
+
+    def feed():
+        group = graphapi.FcbGroup(group_id, graph)
+        group.get_feed()
+        group.set_feed(commit=False)
+        return len(group.feed) + 1
+
+    def filter_object():
+        user = graphapi.FcbUser(user_id, graph)
+        sample = sim.dataset.user(1)
+        sample["metadata"] = {"type": "user"}
+        for i in xrange(iterations):
+            user.filter_object(dict(sample))
+        return iterations
+
+    def update():
+        user = graphapi.FcbUser(user_id, graph)
+        sample = sim.dataset.user(1)
+        for i in xrange(iterations):
+            user.facebook_object = dict(sample)
+            user.update()
+        return iterations
+
+    def db_update():
+        user = graphapi.FcbUser(user_id, graph)
+        for i in xrange(iterations):
+            user.db_update()
+        return iterations
+
+    return {
+        "members": members,
+        "feed": feed,
+        "filter_object": filter_object,
+        "update": update,
+        "db_update": db_update,
+    }
+
+
+def compare(results, previous):
+    """Prints results, with their change since the previous run."""
+    for name, result in sorted(results.items()):
+        if name == "startup":
+            line = "%-14s import %.1fms, process %.1fms" % (
+                name, result["import_seconds"] * 1000,
+                result["process_seconds"] * 1000)
+            before = previous.get(name)
+            if before:
+                line += "  %+.1f%% vs %s" % ((result["import_seconds"] /
+                    before["import_seconds"] - 1) * 100, before["version"])
+            print line
+            continue
+        line = "%-14s %9.1f objects/s %6.2f requests/object" % (
+            name, result["objects_per_second"] or 0,
+            result["requests_per_object"] or 0)
+        if result["latency_p50"] is not None:
+            line += "  p50 %6.1fms p99 %6.1fms" % (
+                result["latency_p50"] * 1000, result["latency_p99"] * 1000)
+        line += "  rss %dMB" % (result["peak_rss_kb"] / 1024)
+        before = previous.get(name)
+        if before and before.get("objects_per_second"):
+            change = (result["objects_per_second"] /
+                      before["objects_per_second"] - 1) * 100
+            line += "  %+.1f%% vs %s" % (change, before["version"])
+        print line
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the graphapi crawls against a simulator")
+    parser.add_argument("benchmarks", nargs="*",
+                        help="benchmarks to run among %s, all by default" %
+                        ", ".join(BENCHMARKS))
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--posts", type=int, default=200)
+    parser.add_argument("--comments", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated latency of Facebook, in seconds")
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--token-lifetime", type=int, default=None)
+    parser.add_argument("--iterations", type=int, default=10000,
+                        help="iterations of the micro-benchmarks")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="JSON file the results are appended to")
+    options = parser.parse_args()
+    for name in options.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+
+    dataset = simulator.Dataset(members=options.members, posts=options.posts,
+                                comments=options.comments)
+    sim = simulator.Simulator(dataset, latency=options.latency,
+                              throttle_rate=options.throttle_rate,
+                              token_lifetime=options.token_lifetime)
+    sim.start()
+    graph = sim.graph("benchmark", rate_limiter=False)
+    functions = benchmarks(options, sim, graph)
+
+    history = []
+    if os.path.exists(options.output):
+        with open(options.output) as file:
+            history = json.load(file)
+    previous = {}
+    for entry in history:
+        for name, result in entry["results"].items():
+            previous[name] = dict(result, version=entry["version"])
+
+    results = {}
+    try:
+        for name in options.benchmarks or BENCHMARKS:
+            if name == "startup":
+                results[name] = startup()
+                continue
+            results[name] = run(name, functions[name], graph)
+    finally:
+        sim.stop()
+
+    compare(results, previous)
+    history.append({
+        "version": version(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "options": vars(options),
+        "results": results,
+    })
+    with open(options.output, "w") as file:
+        json.dump(history, file, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,507 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A resumable crawler of groups, their feed, comments and users.
+
+Every fetch is a task of a durable queue kept in an sqlite database:
+
+    group      the group itself, then queues its feed and members
+    feed       the posts of a group, page by page; queues their comments
+    members    the members of a group, page by page; queues them as users
+    comments   the comments of a post; queues their authors as users
+    user       users, stored by batches of ids_per_request
+
+Tasks run on a WorkerPool, the highest priority first: parents before
+their children, and the fresh data of an incremental sync (see
+graphapi.Base.sync_connection) before the backfill of a full=True crawl.
+A task is identified by its kind and object id, so that an object is
+only queued once, and the paging cursor of a connection is checkpointed
+after every page is stored. A crawl which is stopped or crashes resumes
+from the checkpoints when it is run again with the same queue:
+
+    queue = TaskQueue("crawl.db")
+    crawler = Crawler(queue, graphapi.context.graph())
+    crawler.add_group(group_id)
+    crawler.run()
+
+graphapi needs the facebook tables of a web2py application, so the
+crawler runs in its shell:
+
+    python web2py.py -S app -M -R applications/app/modules/crawler.py \\
+        -A --queue crawl.db GROUP_ID
+
+"""
+
+import Queue
+import argparse
+import collections
+import os
+import signal
+import sqlite3
+import threading
+import time
+
+import facebook
+import graphapi
+
+# A task of a TaskQueue. full is True for the tasks of a full crawl
+Task = collections.namedtuple("Task", "id kind object_id priority full "
+                              "cursor attempts parent")
+
+
+class CrawlError(Exception):
+    """A page could not be fetched; the task is retried later."""
+
+
+class _Interrupted(Exception):
+    """Raised in a task when the crawler is stopped between two pages."""
+
+
+class TaskQueue(object):
+    """A durable priority queue of crawl tasks, in an sqlite database.
+
+    Tasks are identified by "kind:object_id" and go from pending to
+    running to done, or failed once they have been tried max_attempts
+    times. The lowest priority runs first, in the order tasks were queued
+    within a priority. A single crawler should use a queue at a time:
+    recover() puts the tasks left running by a crash back in the queue.
+
+    """
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, path=":memory:"):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS task ("
+            "id TEXT PRIMARY KEY, kind TEXT, object_id TEXT, "
+            "priority INTEGER, full INTEGER, state TEXT, cursor TEXT, "
+            "attempts INTEGER, error TEXT, parent TEXT, queued REAL, "
+            "updated REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS task_state "
+                         "ON task (state, priority, queued)")
+        self._db.commit()
+
+    def __len__(self):
+        """Number of tasks pending or running."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COUNT(*) FROM task WHERE state IN (?, ?)",
+                (self.PENDING, self.RUNNING)).fetchone()[0]
+
+    def put(self, kind, object_id, priority, full=False, parent=None,
+            again=False):
+        """Queues a task unless it already is.
+
+        A task which is done or failed is only queued again if again is
+        True; a pending one keeps its cursor. Returns True if the task
+        was queued.
+
+        """
+        task_id = "%s:%s" % (kind, object_id)
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT OR IGNORE INTO task (id, kind, object_id, priority, "
+                "full, state, attempts, parent, queued, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)",
+                (task_id, kind, object_id, priority, int(full), self.PENDING,
+                 parent, now, now))
+            queued = cursor.rowcount > 0
+            if not queued and again:
+                cursor = self._db.execute(
+                    "UPDATE task SET state = ?, priority = ?, full = ?, "
+                    "cursor = NULL, attempts = 0, error = NULL, parent = ?, "
+                    "queued = ?, updated = ? WHERE id = ? AND state IN (?, ?)",
+                    (self.PENDING, priority, int(full), parent, now, now,
+                     task_id, self.DONE, self.FAILED))
+                queued = cursor.rowcount > 0
+            self._db.commit()
+        return queued
+
+    def claim(self, batch_sizes=None):
+        """Marks the next tasks as running and returns them.
+
+        The first task is the pending one with the lowest priority. Up to
+        batch_sizes[kind] pending tasks of the same kind and priority are
+        claimed with it (one by default). Returns [] if no task is
+        pending.
+
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT kind, priority FROM task WHERE state = ? "
+                "ORDER BY priority, queued LIMIT 1",
+                (self.PENDING,)).fetchone()
+            if row is None:
+                return []
+            kind, priority = row
+            limit = (batch_sizes or {}).get(kind, 1)
+            tasks = [Task(id, kind, object_id, priority, bool(full), cursor,
+                          attempts, parent)
+                     for id, object_id, full, cursor, attempts, parent in
+                     self._db.execute(
+                         "SELECT id, object_id, full, cursor, attempts, "
+                         "parent FROM task WHERE state = ? AND kind = ? AND "
+                         "priority = ? ORDER BY queued LIMIT ?",
+                         (self.PENDING, kind, priority, limit))]
+            self._db.executemany(
+                "UPDATE task SET state = ?, updated = ? WHERE id = ?",
+                [(self.RUNNING, time.time(), task.id) for task in tasks])
+            self._db.commit()
+        return tasks
+
+    def _set(self, task, **columns):
+        columns["updated"] = time.time()
+        names = sorted(columns)
+        with self._lock:
+            self._db.execute(
+                "UPDATE task SET %s WHERE id = ?" %
+                ", ".join("%s = ?" % name for name in names),
+                [columns[name] for name in names] + [task.id])
+            self._db.commit()
+
+    def checkpoint(self, task, cursor):
+        """Saves the cursor of the last page of task which was stored."""
+        self._set(task, cursor=cursor)
+
+    def done(self, task):
+        self._set(task, state=self.DONE, cursor=None, error=None)
+
+    def release(self, task):
+        """Puts a running task back in the queue, with its cursor."""
+        self._set(task, state=self.PENDING)
+
+    def fail(self, task, error, max_attempts=3):
+        """Puts task back in the queue, or fails it after max_attempts."""
+        attempts = task.attempts + 1
+        self._set(task, attempts=attempts, error=error,
+                  state=self.FAILED if attempts >= max_attempts
+                  else self.PENDING)
+
+    def recover(self):
+        """Puts the tasks left running back in the queue.
+
+        Returns the number of tasks recovered.
+
+        """
+        with self._lock:
+            cursor = self._db.execute(
+                "UPDATE task SET state = ? WHERE state = ?",
+                (self.PENDING, self.RUNNING))
+            self._db.commit()
+        return cursor.rowcount
+
+    def statistics(self):
+        """Returns the number of tasks by kind and state."""
+        statistics = {}
+        with self._lock:
+            for kind, state, count in self._db.execute(
+                    "SELECT kind, state, COUNT(*) FROM task "
+                    "GROUP BY kind, state"):
+                statistics.setdefault(kind, {})[state] = count
+        return statistics
+
+    def close(self):
+        self._db.close()
+
+
+class Crawler(object):
+    """Runs the tasks of a TaskQueue with the graphapi classes.
+
+    Tasks are fetched by max_workers threads. The database is written by
+    one of them at a time, so context.db must be usable from any thread.
+    The comments of the posts are only crawled if comments is True. A
+    task which fails is retried, from its last checkpoint, until it has
+    been tried max_attempts times.
+
+    """
+    # Priority of the tasks by kind, the lowest first
+    PRIORITIES = {
+        "group": 0,
+        "feed": 1,
+        "members": 2,
+        "comments": 3,
+        "user": 4,
+    }
+
+    # Added to the priority of the tasks of a full crawl, which run after
+    # the ones of incremental syncs
+    BACKFILL = 10
+
+    def __init__(self, queue, graph, max_workers=4, comments=True,
+                 max_attempts=3, page_size=100):
+        self.queue = queue
+        self.graph = graph
+        self.max_workers = max_workers
+        self.comments = comments
+        self.max_attempts = max_attempts
+        self.page_size = page_size
+        self.batch_sizes = {"user": graphapi.Base.ids_per_request}
+        self.handlers = {
+            "group": self.crawl_group,
+            "feed": self.crawl_feed,
+            "members": self.crawl_members,
+            "comments": self.crawl_comments,
+            "user": self.crawl_users,
+        }
+        self._db_lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def add_group(self, group_id, full=False):
+        """Queues the crawl of a group, all of it if full is True.
+
+        The group is crawled again if it was already, syncing its feed and
+        members incrementally unless full is True.
+
+        """
+        return self.queue.put("group", group_id, self._priority("group", full),
+                              full=full, again=True)
+
+    def _priority(self, kind, full):
+        return self.PRIORITIES[kind] + (self.BACKFILL if full else 0)
+
+    def _child(self, task, kind, object_id, again=False):
+        """Queues a task made necessary by task."""
+        return self.queue.put(kind, object_id,
+                              self._priority(kind, task.full), full=task.full,
+                              parent=task.id, again=again)
+
+    def run(self):
+        """Runs the tasks until the queue is empty or stop() is called.
+
+        Tasks left running by a previous run are resumed first. A run is
+        a session of graphapi.context (see Context.new_session). Returns
+        the statistics of the queue.
+
+        """
+        self._stopping.clear()
+        self.queue.recover()
+        graphapi.context.new_session()
+        pool = facebook.WorkerPool(self.max_workers)
+        done = Queue.Queue()
+        running = 0
+        try:
+            while True:
+                while running < self.max_workers and \
+                        not self._stopping.is_set():
+                    tasks = self.queue.claim(self.batch_sizes)
+                    if not tasks:
+                        break
+                    pool.submit(self._execute, tasks).add_done_callback(
+                        done.put)
+                    running += 1
+                if not running:
+                    break
+                # Wait for a task to end, it may have queued others. The
+                # timeout lets the signal handlers of main() run
+                while True:
+                    try:
+                        done.get(timeout=1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+        finally:
+            pool.shutdown(wait=False)
+        return self.queue.statistics()
+
+    def stop(self):
+        """Stops the crawl once the pages being stored are.
+
+        Running tasks go back to the queue with their cursor. run()
+        returns once they have.
+
+        """
+        self._stopping.set()
+
+    def _execute(self, tasks):
+        try:
+            self.handlers[tasks[0].kind](tasks)
+        except _Interrupted:
+            for task in tasks:
+                self.queue.release(task)
+        except Exception, e:
+            for task in tasks:
+                self.queue.fail(task, "%s: %s" % (type(e).__name__, e),
+                                self.max_attempts)
+        else:
+            for task in tasks:
+                self.queue.done(task)
+
+    def _store(self, objects, **kwargs):
+        with self._db_lock:
+            return graphapi.Base.bulk_upsert(objects, **kwargs)
+
+    def _pages(self, task, instance, connection, fields, time_field=None,
+               incremental=True):
+        """Yields the pages of a connection of instance.
+
+        Paging starts at the cursor of task. Unless task is a full crawl,
+        only the items newer than the watermark of the connection are
+        read if incremental is True. The cursor is checkpointed once the
+        caller is done with a page, and the watermark saved once the
+        whole connection has been read.
+
+        """
+        args = {"fields": fields, "limit": self.page_size}
+        options = {}
+        watermark = None
+        if incremental and not task.full:
+            watermark = graphapi.context.watermarks.get(instance.facebook_id,
+                                                        connection)
+        if watermark is not None:
+            if time_field and watermark.time is not None:
+                options["since"] = watermark.time
+                options["time_field"] = time_field
+                if time_field == "created_time":
+                    # Facebook filters since on the creation time
+                    args["since"] = watermark.time
+            options["seen"] = watermark.ids
+
+        def fetch(url):
+            response = instance.get(self.graph.get_page, url,
+                                    cache_kind=connection)
+            if response is None:
+                raise CrawlError("could not fetch %s" % url)
+            return response
+
+        paginator = facebook.Paginator(
+            self.graph, instance.facebook_id + "/" + connection, args,
+            cache_kind=connection, prefetch=1, after=task.cursor,
+            fetch=fetch, **options)
+        # The watermark is known from the first page. A task resumed from
+        # a checkpoint leaves the previous one
+        first = incremental and task.cursor is None
+        for page, url in paginator:
+            yield page
+            if first:
+                instance.pending_watermark(connection, page, time_field,
+                                           watermark)
+                first = False
+            self.queue.checkpoint(task, paginator.cursor)
+            if url and self._stopping.is_set():
+                paginator.close()
+                raise _Interrupted()
+        if incremental:
+            instance.commit_watermark(connection)
+
+    def crawl_group(self, tasks):
+        for task in tasks:
+            group = graphapi.Base.factory("group", task.object_id, self.graph)
+            self._store([group])
+            self._child(task, "feed", task.object_id, again=True)
+            self._child(task, "members", task.object_id, again=True)
+
+    def crawl_feed(self, tasks):
+        for task in tasks:
+            group = graphapi.Base.factory("group", task.object_id, self.graph)
+            # The feed is sorted by last activity: commented posts come
+            # back, with their new comments
+            for page in self._pages(task, group, "feed", "id,updated_time",
+                                    "updated_time"):
+                ids = [item["id"] for item in page]
+                if not ids:
+                    continue
+                # The first post fetches the others and their authors
+                posts = [graphapi.FcbGroupPost(ids[0], self.graph)]
+                posts[0].prefetch(ids[1:])
+                posts.extend(graphapi.FcbGroupPost(id, self.graph)
+                             for id in ids[1:])
+                self._store(posts, facebook_group=group.facebook_id)
+                if self.comments:
+                    for id in ids:
+                        self._child(task, "comments", id, again=True)
+
+    def crawl_members(self, tasks):
+        for task in tasks:
+            group = graphapi.Base.factory("group", task.object_id, self.graph)
+            for page in self._pages(task, group, "members", "id"):
+                for item in page:
+                    self._child(task, "user", item["id"], again=task.full)
+
+    def crawl_comments(self, tasks):
+        # Comments come from the oldest one, so they are read whole. The
+        # post was fetched in advance by its feed task
+        for task in tasks:
+            post = graphapi.FcbGroupPost(task.object_id, self.graph)
+            for page in self._pages(task, post, "comments", "id,from",
+                                    incremental=False):
+                for item in page:
+                    author = item.get("from")
+                    if author and "id" in author:
+                        self._child(task, "user", author["id"],
+                                    again=task.full)
+
+    def crawl_users(self, tasks):
+        ids = [task.object_id for task in tasks]
+        # The first user fetches the others, see Base.prefetch
+        users = [graphapi.Base.factory("user", ids[0], self.graph)]
+        users[0].prefetch(ids[1:])
+        users.extend(graphapi.Base.factory("user", id, self.graph)
+                     for id in ids[1:])
+        self._store(users)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Crawls Facebook groups to the database")
+    parser.add_argument("groups", nargs="*",
+                        help="ids of the groups to crawl, none to resume "
+                        "the crawl")
+    parser.add_argument("--queue", default="crawl.db",
+                        help="sqlite database of the task queue")
+    parser.add_argument("--watermarks", default=None,
+                        help="sqlite database of the watermarks, see "
+                        "graphapi.WatermarkStore; QUEUE-watermarks.db by "
+                        "default")
+    parser.add_argument("--types", default=None,
+                        help="sqlite database of the object types, see "
+                        "graphapi.TypeCache; QUEUE-types.db by default")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--full", action="store_true",
+                        help="crawl the whole groups instead of syncing "
+                        "what changed")
+    parser.add_argument("--no-comments", action="store_true")
+    options = parser.parse_args()
+
+    # The watermarks and types are kept next to the queue, so that a crawl
+    # run again only syncs what changed
+    base = os.path.splitext(options.queue)[0]
+    context = graphapi.context
+    graphapi.configure(
+        db=context.db, db_factory=context.db_factory, app_id=context.app_id,
+        app_secret=context.app_secret, access_token=context.access_token,
+        watermarks_path=options.watermarks or base + "-watermarks.db",
+        types_path=options.types or base + "-types.db")
+    queue = TaskQueue(options.queue)
+    crawler = Crawler(queue, graphapi.context.graph(),
+                      max_workers=options.workers,
+                      comments=not options.no_comments)
+    for group_id in options.groups:
+        crawler.add_group(group_id, full=options.full)
+
+    # The first signal stops the crawl at the next checkpoint
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: crawler.stop())
+    statistics = crawler.run()
+    for kind, states in sorted(statistics.items()):
+        print "%-9s %s" % (kind, ", ".join(
+            "%d %s" % (count, state) for state, count in sorted(states.items())))
+
+if __name__ == '__main__':
+    main()
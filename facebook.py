@@ -33,16 +33,29 @@ if user:
 
 """
 
-import cgi
+import bisect
+import calendar
+import collections
+import re
+import sqlite3
 import time
 import urllib
-import urllib2
 import httplib
 import hashlib
 import hmac
 import base64
+import imghdr
+import mimetypes
+import mmap
+import os
+import zlib
 import logging
+import random
 import socket
+import sys
+import tempfile
+import threading
+import Queue
 
 # Find a JSON parser
 try:
@@ -59,6 +72,1808 @@ try:
     from urlparse import parse_qs
 except ImportError:
     from cgi import parse_qs
+from urlparse import urlsplit, urljoin, parse_qsl
+from StringIO import StringIO
+
+
+class PooledResponse(object):
+    """A response read from a connection owned by a ConnectionPool.
+
+    It mimics the file like object returned by urllib2.urlopen (read(),
+    info(), url) and hands the underlying connection back to its pool
+    once the body has been read and the response is closed.
+
+    """
+    def __init__(self, pool, key, conn, response, url, reused=False):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        # Whether the request was sent on a kept-alive connection
+        self.reused = reused
+        # Bytes received from the socket so far, before decompression
+        self.bytes_received = 0
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self._decoder = None
+        encoding = (response.getheader("content-encoding") or "").lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self._decoder = zlib.decompressobj()
+        self._raw_deflate = encoding == "deflate"
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def _read_raw(self, amt=None):
+        data = self._response.read(amt)
+        self.bytes_received += len(data)
+        self._pool._count("bytes_received", len(data))
+        return data
+
+    def _decompress(self, data, max_length=0):
+        try:
+            return self._decoder.decompress(data, max_length)
+        except zlib.error:
+            if not self._raw_deflate:
+                raise
+            # Some servers send raw deflate data without a zlib header
+            self._raw_deflate = False
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data, max_length)
+
+    def read(self, amt=None):
+        """Reads up to amt bytes of the body, decompressed if needed."""
+        if self._response is None:
+            return ""
+        if self._decoder is None:
+            data = self._read_raw(amt)
+        elif amt is None:
+            data = self._decompress(self._decoder.unconsumed_tail +
+                                    self._read_raw())
+            data += self._decoder.flush()
+        else:
+            # Decompress as a stream, reading the socket only when the
+            # data already received is exhausted
+            chunks = []
+            size = 0
+            while size < amt:
+                if self._decoder.unconsumed_tail:
+                    chunk = self._decompress(self._decoder.unconsumed_tail,
+                                             amt - size)
+                else:
+                    raw = self._read_raw(amt)
+                    if not raw:
+                        chunks.append(self._decoder.flush())
+                        break
+                    chunk = self._decompress(raw, amt - size)
+                chunks.append(chunk)
+                size += len(chunk)
+            data = "".join(chunks)
+        self._pool._count("bytes_decoded", len(data))
+        return data
+
+    def close(self):
+        """Releases the connection.
+
+        The connection is given back to the pool only if the body has
+        been fully consumed and the server did not ask to close it.
+        Otherwise it is closed, since the stream is in an unknown state.
+
+        """
+        response, self._response = self._response, None
+        if response is None:
+            return
+        if response.length == 0:
+            # Bodyless responses (204, 304, HEAD) are never marked as
+            # closed by httplib until read.
+            response.close()
+        if response.isclosed() and not response.will_close:
+            self._pool._put_connection(self._key, self._conn)
+        else:
+            response.close()
+            self._pool._discard_connection(self._conn)
+
+
+class ConnectionPool(object):
+    """A thread safe pool of keep-alive HTTP(S) connections.
+
+    Connections are kept per (scheme, host, port), so that requests to
+    graph.facebook.com and api.facebook.com each reuse their own TCP and
+    TLS sessions instead of paying a full handshake on every call.
+
+    maxsize is the number of idle connections kept per host; extra
+    connections are closed when released. Connections idle for more
+    than idle_timeout seconds are evicted instead of being reused.
+
+    A request failing on a kept-alive connection which the server closed
+    is sent again once on a new connection, unless it could have been
+    applied already: a request whose method is not idempotent (a POST)
+    is only sent again if it failed before it was fully sent.
+
+    """
+    REDIRECT_CODES = (301, 302, 303, 307)
+
+    # Methods which can be sent twice without changing their effect
+    IDEMPOTENT_METHODS = ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+
+    def __init__(self, maxsize=10, idle_timeout=60, timeout=None,
+                 compress=True):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        # Ask for gzip/deflate bodies, decompressed while they are read
+        self.compress = compress
+        self._idle = {}
+        self._lock = threading.Lock()
+        # Process the idle connections belong to, see _get_connection
+        self._pid = os.getpid()
+        self._stats = {
+            "requests": 0,
+            "created": 0,
+            "reused": 0,
+            "evicted": 0,
+            "discarded": 0,
+            # Body bytes as received on the wire and once decompressed
+            "bytes_received": 0,
+            "bytes_decoded": 0,
+        }
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _new_connection(self, key, timeout):
+        scheme, host, port = key
+        if timeout is None:
+            timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+        if scheme == "https":
+            conn = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=timeout)
+        self._count("created")
+        return conn
+
+    def _get_connection(self, key, timeout):
+        """Returns (connection, reused) for the given host key."""
+        if self._pid != os.getpid():
+            # In a forked process the idle connections are the sockets of
+            # the parent: forget them instead of sharing them
+            self._lock = threading.Lock()
+            self._idle = {}
+            self._pid = os.getpid()
+        now = time.time()
+        stale = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                candidate, last_used = idle.pop()
+                if now - last_used > self.idle_timeout:
+                    stale.append(candidate)
+                    continue
+                conn = candidate
+                break
+            self._stats["evicted"] += len(stale)
+            if conn is not None:
+                self._stats["reused"] += 1
+        for candidate in stale:
+            candidate.close()
+        if conn is None:
+            return self._new_connection(key, timeout), False
+        if timeout is not None:
+            conn.timeout = timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(timeout)
+        return conn, True
+
+    def _put_connection(self, key, conn):
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+            self._stats["discarded"] += 1
+        conn.close()
+
+    def _discard_connection(self, conn):
+        self._count("discarded")
+        conn.close()
+
+    def evict_idle(self):
+        """Closes every connection idle for more than idle_timeout."""
+        now = time.time()
+        stale = []
+        with self._lock:
+            for key, idle in self._idle.items():
+                fresh = []
+                for conn, last_used in idle:
+                    if now - last_used > self.idle_timeout:
+                        stale.append(conn)
+                    else:
+                        fresh.append((conn, last_used))
+                self._idle[key] = fresh
+            self._stats["evicted"] += len(stale)
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def clear(self):
+        """Closes all the idle connections of the pool."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, last_used in connections:
+                conn.close()
+
+    def statistics(self):
+        """Returns a dict with the pool counters and idle connections."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = dict(("%s://%s:%s" % key, len(idle))
+                                 for key, idle in self._idle.items())
+        return stats
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None,
+                redirect=5):
+        """Performs an HTTP request on a pooled connection.
+
+        Redirections are followed for up to redirect hops. Returns a
+        PooledResponse whatever the status code is: unlike urllib2, HTTP
+        errors are not raised, so callers can read Facebook's error body.
+
+        """
+        if timeout is None:
+            timeout = self.timeout
+        headers = dict(headers or {})
+        if self.compress:
+            headers.setdefault("Accept-Encoding", "gzip, deflate")
+        while True:
+            parts = urlsplit(url)
+            scheme = parts.scheme or "https"
+            default_port = 443 if scheme == "https" else 80
+            key = (scheme, parts.hostname, parts.port or default_port)
+            path = parts.path or "/"
+            if parts.query:
+                path += "?" + parts.query
+
+            self._count("requests")
+            conn, reused = self._get_connection(key, timeout)
+            sent = False
+            try:
+                conn.request(method, path, body, headers)
+                sent = True
+                response = conn.getresponse()
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                if sent and method not in self.IDEMPOTENT_METHODS:
+                    # The server may have applied the request before the
+                    # connection failed: sending it again could apply it
+                    # twice. The caller decides whether to retry
+                    raise
+                # The server closed the kept-alive connection while it
+                # was idle in the pool; retry once on a brand new one.
+                if hasattr(body, "seek"):
+                    # Streamed bodies have to be sent again from the start
+                    body.seek(0)
+                conn = self._new_connection(key, timeout)
+                reused = False
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+
+            pooled = PooledResponse(self, key, conn, response, url, reused)
+            location = response.getheader("location")
+            if (redirect and location and
+                    response.status in self.REDIRECT_CODES):
+                pooled.read()
+                pooled.close()
+                redirect -= 1
+                url = urljoin(url, location)
+                if response.status == 303 or method == "POST" and \
+                        response.status in (301, 302):
+                    method, body = "GET", None
+                    headers.pop("Content-Type", None)
+                continue
+            return pooled
+
+
+default_pool = ConnectionPool()
+
+
+def _get_pool(pool):
+    return pool if pool is not None else default_pool
+
+
+def _read_response(response):
+    """Reads the whole body of a PooledResponse and releases it."""
+    try:
+        return response.read()
+    finally:
+        response.close()
+
+
+class CassetteError(Exception):
+    """Raised when a request was not recorded in the replayed cassette."""
+
+
+class RecordedResponse(object):
+    """A response served from memory, with the PooledResponse interface."""
+    def __init__(self, status, reason, headers, body, url):
+        self.status = status
+        self.reason = reason
+        self.url = url
+        self.msg = httplib.HTTPMessage(StringIO("".join(
+            "%s: %s\r\n" % (name, value) for name, value in headers)))
+        self.reused = True
+        self.bytes_received = 0
+        self._body = StringIO(body)
+
+    def info(self):
+        return self.msg
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self._body.read() if amt is None else self._body.read(amt)
+        self.bytes_received += len(data)
+        return data
+
+    def close(self):
+        pass
+
+
+class Cassette(object):
+    """Records the traffic of a GraphAPI client to replay it offline.
+
+    A cassette is a transport: it is given to GraphAPI instead of its
+    ConnectionPool. In "record" mode requests are sent through pool and
+    their responses stored in the sqlite database at path; in "replay"
+    mode they are served from it without any network access::
+
+       graph = facebook.GraphAPI(token, transport=Cassette("crawl.db"))
+       ...
+       graph = facebook.GraphAPI(token, transport=Cassette("crawl.db",
+                                                           "replay"))
+
+    Requests are keyed by their method, their URL without access token
+    and a hash of their body, so that a crawl can be replayed with
+    another token. A request sent several times (a retried error, a page
+    polled twice) is replayed in the recorded order, the last response
+    being repeated once exhausted. Bodies are stored decompressed, then
+    zlib compressed. Replayed responses wait latency times the recorded
+    latency: 0 replays at full speed, 1 as fast as Facebook answered.
+
+    """
+    # Headers describing the encoding of the body as it was received
+    SKIPPED_HEADERS = ("content-encoding", "content-length",
+                       "transfer-encoding", "connection")
+
+    def __init__(self, path, mode="record", pool=None, latency=0):
+        if mode not in ("record", "replay"):
+            raise ValueError("mode should be 'record' or 'replay'")
+        self.path = path
+        self.mode = mode
+        self.pool = pool
+        if mode == "record" and pool is None:
+            self.pool = ConnectionPool()
+        self.latency = latency
+        self.stats = {"recorded": 0, "replayed": 0, "misses": 0}
+        self._sequences = {}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS cassette ("
+                         "key TEXT, seq INTEGER, status INTEGER, "
+                         "reason TEXT, headers TEXT, body BLOB, "
+                         "latency REAL, recorded_at REAL, "
+                         "PRIMARY KEY (key, seq))")
+        self._db.commit()
+
+    @staticmethod
+    def key(method, url, body, headers):
+        """Returns the key identifying a request in the cassette."""
+        content_type = (headers or {}).get("Content-Type", "")
+        if body and content_type == "application/x-www-form-urlencoded":
+            body = urllib.urlencode(sorted(
+                (name, value) for name, value
+                in parse_qsl(body, keep_blank_values=True)
+                if name not in ("access_token", "appsecret_proof")))
+        elif body and "boundary=" in content_type:
+            # Multipart boundaries are random
+            body = body.replace(content_type.split("boundary=")[1],
+                                "boundary")
+        digest = hashlib.sha1(body or "").hexdigest()
+        return "%s %s %s" % (method, ResponseCache.key(url), digest)
+
+    def _next_sequence(self, key):
+        with self._lock:
+            seq = self._sequences.get(key, 0)
+            self._sequences[key] = seq + 1
+            return seq
+
+    def urlopen(self, method, url, body=None, headers=None, timeout=None):
+        if hasattr(body, "read"):
+            # Streamed bodies are read once, to be hashed and sent
+            body = body.read()
+        key = self.key(method, url, body, headers)
+        seq = self._next_sequence(key)
+        if self.mode == "replay":
+            return self._replay(key, seq, url)
+
+        started = time.time()
+        response = self.pool.urlopen(method, url, body, headers, timeout)
+        try:
+            data = response.read()
+        finally:
+            response.close()
+        latency = time.time() - started
+        recorded = [(name, value) for name, value in response.msg.items()
+                    if name.lower() not in self.SKIPPED_HEADERS]
+        with self._lock:
+            self.stats["recorded"] += 1
+            self._db.execute(
+                "INSERT OR REPLACE INTO cassette (key, seq, status, reason, "
+                "headers, body, latency, recorded_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, seq, response.status, response.reason,
+                 json.dumps(recorded), sqlite3.Binary(zlib.compress(data)),
+                 latency, started))
+            self._db.commit()
+        return RecordedResponse(response.status, response.reason, recorded,
+                                data, response.url)
+
+    def _replay(self, key, seq, url):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT status, reason, headers, body, latency "
+                "FROM cassette WHERE key = ? AND seq <= ? "
+                "ORDER BY seq DESC LIMIT 1", (key, seq)).fetchone()
+            self.stats["misses" if row is None else "replayed"] += 1
+        if row is None:
+            raise CassetteError("%s was not recorded in %s" %
+                                (key, self.path))
+        status, reason, headers, body, latency = row
+        if self.latency:
+            time.sleep(latency * self.latency)
+        return RecordedResponse(status, reason, json.loads(headers),
+                                zlib.decompress(body), url)
+
+    def rewind(self):
+        """Replays every request from its first recorded response."""
+        with self._lock:
+            self._sequences.clear()
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        if self.pool is not None:
+            stats["pool"] = self.pool.statistics()
+        return stats
+
+    def clear(self):
+        if self.pool is not None:
+            self.pool.clear()
+
+    def close(self):
+        self.clear()
+        with self._lock:
+            self._db.close()
+
+
+class Future(object):
+    """The pending result of a call submitted to a WorkerPool."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def _finish(self, result=None, exc_info=None):
+        with self._lock:
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        """Calls callback(future) once the call is done."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def exception(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Future not done after %s seconds" % timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        """Waits for the call and returns its result or raises its error."""
+        if not self._done.wait(timeout):
+            raise RuntimeError("Future not done after %s seconds" % timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class WorkerPool(object):
+    """A fixed size pool of daemon threads running submitted calls.
+
+    Threads are started lazily, up to max_workers, as calls are
+    submitted. Network bound work such as Graph API requests releases
+    the GIL, so a few threads are enough to overlap round trips.
+
+    """
+    def __init__(self, max_workers=4):
+        assert max_workers > 0, "max_workers should be positive"
+        self.max_workers = max_workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, function, args, kwargs = item
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                future._finish(exc_info=sys.exc_info())
+            else:
+                future._finish(result)
+
+    def submit(self, function, *args, **kwargs):
+        """Schedules function(*args, **kwargs) and returns a Future."""
+        future = Future()
+        with self._lock:
+            if len(self._threads) < self.max_workers:
+                thread = threading.Thread(target=self._worker)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        self._queue.put((future, function, args, kwargs))
+        return future
+
+    def map(self, function, iterable):
+        """Returns [function(item) for item in iterable], run in parallel.
+
+        The first error raised by a call is raised once all of them are
+        done.
+
+        """
+        futures = [self.submit(function, item) for item in iterable]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """Stops the threads once the submitted calls are done."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+class RateLimiter(object):
+    """A thread safe token bucket adapting its rate to Facebook's limits.
+
+    Requests are let through at rate requests per second. The rate is
+    halved each time Facebook answers with a throttling error and
+    lowered when the X-App-Usage/X-Page-Usage headers report a usage
+    above high_usage percent; it then grows back by about increase
+    requests per second, every second, up to ceiling. The usage stays
+    high for the whole window Facebook measures it on, so the rate is
+    lowered at most once every usage_interval seconds on its account,
+    and held in between. The bucket is shared by every thread of a
+    client (an AsyncGraphAPI included).
+
+    """
+    def __init__(self, rate=50.0, ceiling=None, floor=0.1, increase=0.5,
+                 decrease=0.5, high_usage=80, usage_interval=10.0):
+        self.rate = float(rate)
+        self.ceiling = float(ceiling or rate)
+        self.floor = floor
+        self.increase = increase
+        self.decrease = decrease
+        self.high_usage = high_usage
+        self.usage_interval = usage_interval
+        self.waited = 0.0
+        self.throttles = 0
+        self.usage = 0
+        self._tokens = 1.0
+        self._updated = time.time()
+        self._braked = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        burst = max(1.0, self.rate)
+        self._tokens = min(burst, self._tokens +
+                           (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Waits until a request may be sent, returns the time waited."""
+        with self._lock:
+            self._refill(time.time())
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.waited += wait
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def _slow_down(self, factor):
+        self.rate = max(self.floor, self.rate * factor)
+        # Forget the burst accumulated at the previous rate
+        self._tokens = min(self._tokens, 0.0)
+
+    def throttled(self):
+        """Called when Facebook answered with a throttling error."""
+        with self._lock:
+            self.throttles += 1
+            self._slow_down(self.decrease)
+
+    def report_usage(self, usage):
+        """Called with the highest percentage of the usage headers."""
+        with self._lock:
+            self.usage = usage
+            if usage >= self.high_usage:
+                now = time.time()
+                if self._braked is None or \
+                        now - self._braked >= self.usage_interval:
+                    # The closer to 100%, the harder we brake
+                    self._braked = now
+                    self._slow_down(max(self.decrease,
+                                        1 - (usage - self.high_usage) / 100.0))
+                return
+        self.success()
+
+    def success(self):
+        """Called after a request that was not throttled."""
+        with self._lock:
+            self.rate = min(self.ceiling,
+                            self.rate + self.increase / max(self.rate, 1.0))
+
+    def statistics(self):
+        with self._lock:
+            return {
+                "rate": self.rate,
+                "waited": self.waited,
+                "throttles": self.throttles,
+                "usage": self.usage,
+            }
+
+
+class MetricsCollector(object):
+    """Aggregates the requests reported by GraphAPI request hooks.
+
+    Keeps, per method and endpoint, a latency histogram and counters of
+    requests, bytes received, retries, error codes, cache and pool
+    statuses. snapshot() returns them as a dict and prometheus() in the
+    Prometheus text exposition format::
+
+       metrics = facebook.MetricsCollector().attach(graph)
+       ...
+       print metrics.prometheus()
+
+    Endpoints are the request paths with their ids replaced by "{id}",
+    so that /123/feed and /456/feed are counted together.
+
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    _ID = re.compile(r"^(\d+(_\d+)*|me)$")
+
+    def __init__(self, buckets=None, prefix="facebook_graph"):
+        self.buckets = tuple(sorted(buckets or self.BUCKETS))
+        self.prefix = prefix
+        self.started = time.time()
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def attach(self, graph):
+        """Registers the collector on the hooks of a GraphAPI client."""
+        graph.add_hook("request_end", self)
+        graph.add_hook("request_error", self)
+        return self
+
+    def detach(self, graph):
+        graph.remove_hook("request_end", self)
+        graph.remove_hook("request_error", self)
+
+    def endpoint(self, path):
+        parts = [self._ID.match(part) and "{id}" or part
+                 for part in path.split("/") if part]
+        return "/" + "/".join(parts)
+
+    @staticmethod
+    def error_code(error):
+        """Returns the Facebook error code of error, or its class name."""
+        result = getattr(error, "result", None)
+        if isinstance(result, dict):
+            if isinstance(result.get("error"), dict):
+                code = result["error"].get("code")
+            else:
+                code = result.get("error_code")
+            if code is not None:
+                return str(code)
+        return type(error).__name__
+
+    def __call__(self, event, info):
+        key = (info["method"], self.endpoint(info["path"]))
+        with self._lock:
+            stats = self._endpoints.get(key)
+            if stats is None:
+                stats = self._endpoints[key] = {
+                    "requests": 0,
+                    "bytes": 0,
+                    "retries": 0,
+                    "latency_sum": 0.0,
+                    "latency_buckets": [0] * (len(self.buckets) + 1),
+                    "errors": {},
+                    "cache": {},
+                    "pool": {},
+                }
+            stats["requests"] += 1
+            stats["bytes"] += info["bytes"]
+            if info["retries"]:
+                stats["retries"] += 1
+            stats["latency_sum"] += info["latency"]
+            stats["latency_buckets"][
+                bisect.bisect_left(self.buckets, info["latency"])] += 1
+            if event == "request_error":
+                code = self.error_code(info["error"])
+                stats["errors"][code] = stats["errors"].get(code, 0) + 1
+            for name in ("cache", "pool"):
+                if info[name] is not None:
+                    counts = stats[name]
+                    counts[info[name]] = counts.get(info[name], 0) + 1
+
+    def snapshot(self):
+        """Returns the metrics collected so far as a dict."""
+        with self._lock:
+            endpoints = {}
+            requests = 0
+            for (method, endpoint), stats in self._endpoints.items():
+                stats = dict(stats, errors=dict(stats["errors"]),
+                             cache=dict(stats["cache"]),
+                             pool=dict(stats["pool"]),
+                             latency_buckets=list(stats["latency_buckets"]))
+                endpoints["%s %s" % (method, endpoint)] = stats
+                requests += stats["requests"]
+        elapsed = time.time() - self.started
+        return {
+            "buckets": list(self.buckets),
+            "elapsed": elapsed,
+            "requests": requests,
+            "throughput": requests / elapsed if elapsed else 0.0,
+            "endpoints": endpoints,
+        }
+
+    def prometheus(self):
+        """Returns the metrics in the Prometheus text format."""
+        prefix = self.prefix
+        lines = []
+
+        def family(name, kind, help):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, kind))
+
+        def sample(name, labels, value):
+            labels = ",".join('%s="%s"' % (label, str(text).replace(
+                "\\", "\\\\").replace('"', '\\"'))
+                for label, text in labels)
+            lines.append("%s_%s{%s} %s" % (prefix, name, labels,
+                                           repr(value)))
+
+        with self._lock:
+            endpoints = sorted((key, dict(stats)) for key, stats in
+                               self._endpoints.items())
+        family("request_duration_seconds", "histogram",
+               "Latency of the Graph API requests.")
+        for (method, endpoint), stats in endpoints:
+            labels = [("method", method), ("endpoint", endpoint)]
+            count = 0
+            for bound, bucket in zip(self.buckets + (None,),
+                                     stats["latency_buckets"]):
+                count += bucket
+                le = "+Inf" if bound is None else repr(bound)
+                sample("request_duration_seconds_bucket",
+                       labels + [("le", le)], count)
+            sample("request_duration_seconds_sum", labels,
+                   stats["latency_sum"])
+            sample("request_duration_seconds_count", labels, count)
+        for name, help in (("bytes", "Bytes received, before decoding."),
+                           ("retries", "Requests retried by RetryPolicy.")):
+            family("%s_total" % name, "counter", help)
+            for (method, endpoint), stats in endpoints:
+                sample("%s_total" % name, [("method", method),
+                                           ("endpoint", endpoint)],
+                       stats[name])
+        for name, label, help in (
+                ("errors", "code", "Failed requests by error code."),
+                ("cache", "status", "Requests by response cache status."),
+                ("pool", "connection", "Requests by pooled connection.")):
+            family("%s_total" % name, "counter", help)
+            for (method, endpoint), stats in endpoints:
+                for value, count in sorted(stats[name].items()):
+                    sample("%s_total" % name, [("method", method),
+                                               ("endpoint", endpoint),
+                                               (label, value)], count)
+        return "\n".join(lines) + "\n"
+
+
+class LRUCache(object):
+    """A thread safe least recently used cache.
+
+    The cache is bounded by the total size of its values (max_bytes, the
+    size of a value being given by sizeof) and/or by its number of
+    entries (max_entries). The least recently used entries are evicted
+    first. If ttl is set, entries expire ttl seconds after being set.
+
+    """
+    def __init__(self, max_bytes=None, max_entries=None, sizeof=len,
+                 ttl=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.size = 0
+        self.evictions = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self) is not self
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                self.size -= size
+                return default
+            self._data[key] = (value, size, expires)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Caches value, for ttl seconds if given instead of self.ttl."""
+        size = self.sizeof(value)
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self.pop(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self._data[key] = (value, size, expires)
+            self.size += size
+            while ((self.max_bytes is not None and
+                    self.size > self.max_bytes) or
+                   (self.max_entries is not None and
+                    len(self._data) > self.max_entries)):
+                evicted, (value, size, expires) = \
+                    self._data.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+CacheEntry = collections.namedtuple("CacheEntry",
+                                    "etag body stored_at kind")
+
+
+class ResponseCache(object):
+    """A cache of Graph API responses revalidated with ETags.
+
+    Responses are kept in an in-memory LRU bounded to max_bytes and, if
+    path is given, in a sqlite database so that they survive restarts.
+
+    ttls maps a kind of response to the number of seconds it is trusted
+    without asking Facebook; once expired it is revalidated with
+    If-None-Match and served from the cache on a 304. The kind is the
+    connection name for connections ("feed", "members"), "objects" for
+    get_objects and the object type for get_object (the cache_kind
+    argument, the metadata type or "object"). For instance
+
+        ResponseCache(ttls={"user": 4 * 3600, "feed": 0})
+
+    trusts users for four hours and always revalidates feeds.
+
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024, path=None, ttls=None,
+                 default_ttl=0):
+        self.memory = LRUCache(max_bytes=max_bytes,
+                               sizeof=lambda entry: len(entry.body))
+        self.ttls = ttls or {}
+        self.default_ttl = default_ttl
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS response_cache ("
+                             "key TEXT PRIMARY KEY, etag TEXT, body BLOB, "
+                             "stored_at REAL, kind TEXT)")
+            self._db.commit()
+
+    @staticmethod
+    def key(url):
+        """Returns url with a hash of its access token and sorted args.
+
+        What a response holds depends on the token (/me, fields needing
+        permissions), so responses are only shared by the requests made
+        with the same token. The token itself is not kept in the cache,
+        nor its appsecret_proof which is derived from it.
+
+        """
+        parts = urlsplit(url)
+        args = []
+        for name, value in parse_qsl(parts.query, keep_blank_values=True):
+            if name == "access_token":
+                args.append(("token_sha1",
+                             hashlib.sha1(value).hexdigest()[:16]))
+            elif name != "appsecret_proof":
+                args.append((name, value))
+        return "%s%s?%s" % (parts.netloc, parts.path,
+                            urllib.urlencode(sorted(args)))
+
+    def count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def statistics(self):
+        with self._lock:
+            stats = dict(self.stats)
+        stats["entries"] = len(self.memory)
+        stats["bytes"] = self.memory.size
+        stats["evictions"] = self.memory.evictions
+        return stats
+
+    def ttl(self, kind):
+        return self.ttls.get(kind, self.default_ttl)
+
+    def is_fresh(self, entry):
+        return time.time() - entry.stored_at < self.ttl(entry.kind)
+
+    def lookup(self, url):
+        """Returns the CacheEntry of url or None."""
+        key = self.key(url)
+        entry = self.memory.get(key)
+        if entry is None and self._db is not None:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT etag, body, stored_at, kind FROM response_cache "
+                    "WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                entry = CacheEntry(row[0], str(row[1]), row[2], row[3])
+                self.memory.set(key, entry)
+        return entry
+
+    def store(self, url, body, etag, kind):
+        self._save(self.key(url), CacheEntry(etag, body, time.time(), kind))
+
+    def revalidate(self, url, entry):
+        """Marks entry as fresh again after a 304 Not Modified."""
+        self.count("revalidated")
+        self._save(self.key(url), entry._replace(stored_at=time.time()))
+
+    def _save(self, key, entry):
+        self.memory.set(key, entry)
+        if self._db is not None:
+            with self._lock:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO response_cache "
+                    "(key, etag, body, stored_at, kind) VALUES (?, ?, ?, ?, ?)",
+                    (key, entry.etag, sqlite3.Binary(entry.body),
+                     entry.stored_at, entry.kind))
+                self._db.commit()
+
+    def clear(self):
+        self.memory.clear()
+        if self._db is not None:
+            with self._lock:
+                self._db.execute("DELETE FROM response_cache")
+                self._db.commit()
+
+
+class StreamedPage(object):
+    """Decodes the data array of a Graph API response as it is read.
+
+    Iterating over a StreamedPage yields the items of the "data" array
+    one at a time, reading the socket chunk_size bytes at a time, so
+    that only the item being decoded is held in memory. The other top
+    level members ("paging", ...) are kept in self.response and are
+    available once the page has been iterated.
+
+    """
+    WHITESPACE = " \t\r\n"
+
+    def __init__(self, file, chunk_size=16384):
+        self._file = file
+        self._chunk_size = chunk_size
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+        self.response = {}
+
+    @property
+    def paging(self):
+        return self.response.get("paging", {})
+
+    @property
+    def next_url(self):
+        return self.paging.get("next")
+
+    def _fill(self):
+        """Reads the next chunk, returns False at the end of the body."""
+        if self._eof:
+            return False
+        data = self._file.read(self._chunk_size)
+        if not data:
+            self._eof = True
+            return False
+        # Drop what has already been decoded
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        return True
+
+    def _peek(self):
+        """Skips whitespace and returns the next character ("" at EOF)."""
+        while True:
+            while (self._pos < len(self._buffer) and
+                    self._buffer[self._pos] in self.WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                return ""
+
+    def _expect(self, characters):
+        character = self._peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of %r at offset %d, got %r" %
+                             (characters, self._pos, character))
+        self._pos += 1
+        return character
+
+    def _value(self):
+        """Decodes the next complete JSON value of the stream."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except ValueError:
+                # The value is not complete yet
+                if not self._fill():
+                    raise
+                continue
+            if end == len(self._buffer) and self._fill():
+                # A number may have been cut at the end of the buffer
+                continue
+            self._pos = end
+            return value
+
+    def __iter__(self):
+        try:
+            self._expect("{")
+            closed = self._peek() == "}"
+            while not closed:
+                key = self._value()
+                self._expect(":")
+                if key == "data" and self._peek() == "[":
+                    self._pos += 1
+                    if self._peek() == "]":
+                        self._pos += 1
+                    else:
+                        while True:
+                            yield self._value()
+                            if self._expect(",]") == "]":
+                                break
+                else:
+                    self.response[key] = self._value()
+                closed = self._expect(",}") == "}"
+        finally:
+            self.close()
+        if self.response.get("error"):
+            raise raise_error(self.response)(self.response)
+
+    def close(self):
+        self._buffer = ""
+        self._file.close()
+
+
+class PageStream(object):
+    """Iterates over the items of every page of a connection.
+
+    Items are decoded from the socket as they arrive (see StreamedPage).
+    self.paging holds the paging member of the last page read, so that
+    the crawl can be resumed from its cursors.
+
+    """
+    def __init__(self, graph, url, max_pages=None):
+        self._graph = graph
+        self.url = url
+        self.max_pages = max_pages
+        self.pages_read = 0
+        self.paging = {}
+
+    def __iter__(self):
+        while self.url and (self.max_pages is None or
+                            self.pages_read < self.max_pages):
+            page = self._graph._stream_request(self.url)
+            for item in page:
+                yield item
+            self.paging = page.paging
+            self.url = page.next_url
+            self.pages_read += 1
+
+
+def _timestamp(value):
+    """Returns the unix time of a Graph API time (ISO 8601 or unix)."""
+    if isinstance(value, (int, long, float)):
+        return value
+    if isinstance(value, basestring) and value.isdigit():
+        return int(value)
+    # Facebook sends times in UTC, as in 2013-05-21T09:47:10+0000
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+def _truncate_page(page, since=None, time_field="created_time", seen=None,
+                   left=None):
+    """Applies the since, seen and max_items conditions of Paginator.
+
+    left is the number of items which can still be yielded. Returns the
+    items of page to yield, whether they end the iteration and whether
+    they do so because the connection was read up to since or up to a
+    seen item, rather than up to max_items.
+
+    """
+    if not isinstance(page, list):
+        return page, False, False
+    reached = False
+    if since is not None:
+        fresh = [item for item in page
+                 if item.get(time_field) is None or
+                 _timestamp(item[time_field]) >= since]
+        reached = len(fresh) < len(page)
+        page = fresh
+    if seen and since is not None:
+        # Items sorted by an update time come back when they are updated:
+        # only the ones which were not updated since are skipped
+        page = [item for item in page
+                if not isinstance(item, dict) or item.get("id") not in seen or
+                item.get(time_field) is None or
+                _timestamp(item[time_field]) > since]
+    elif seen:
+        for index, item in enumerate(page):
+            if isinstance(item, dict) and item.get("id") in seen:
+                reached = True
+                page = page[:index]
+                break
+    done = reached
+    if left is not None:
+        done = done or len(page) >= left
+        page = page[:left]
+    return page, done, reached
+
+
+class Paginator(object):
+    """Iterates over the pages of a connection, fetching them ahead.
+
+    Iterating yields (page, next_url) like GraphAPI._paginator did. A
+    background thread fetches up to prefetch pages ahead of the caller
+    into a bounded buffer, so that the network latency of the next pages
+    overlaps with the processing of the current one (prefetch=0 fetches
+    pages on demand).
+
+    Pages are followed with their paging.cursors.after cursor when there
+    is one. There is no page limit by default; iteration stops at the
+    last page or at the first of these conditions:
+
+        max_pages: number of pages read
+        max_items: number of items yielded, the last page is truncated
+        deadline: unix time after which no more page is yielded
+        since: unix time (or Graph API time); items whose time_field is
+               older end the iteration, as in a feed sorted by time
+        seen: ids of items already read; the first of them met ends the
+              iteration, as in a connection sorted from the newest item.
+              With since, they are skipped instead unless their
+              time_field is newer than since, as in a feed sorted by
+              last activity where updated items come back
+
+    self.cursor is the after cursor of the last page yielded. Pass it
+    back as after= to resume the iteration where it stopped.
+
+    self.complete is True once the iteration reached the last page, since
+    or a seen item. It stays False when it ended on another condition or
+    on a page fetch returning None, the items read are then only part of
+    the connection.
+
+    fetch(url) returns (page, next_url) and defaults to graph.get_page;
+    it may return None to end the iteration.
+
+    """
+    def __init__(self, graph, path, args=None, cache_kind=None, prefetch=2,
+                 max_pages=None, max_items=None, deadline=None, since=None,
+                 time_field="created_time", after=None, fetch=None,
+                 seen=None):
+        args = dict(args or {})
+        if after:
+            args["after"] = after
+        self.url, post_data = graph.prepare_url_with_post_data(path, args)
+        self.cursor = args.get("after")
+        self.prefetch = prefetch
+        self.max_pages = max_pages
+        self.max_items = max_items
+        self.deadline = deadline
+        self.since = _timestamp(since) if since is not None else None
+        self.time_field = time_field
+        self.seen = frozenset(seen or ())
+        self.pages_read = 0
+        self.items_read = 0
+        self.complete = False
+        self._base_url = self.url
+        self._cache_kind = cache_kind
+        self._fetch = fetch or (
+            lambda url: graph.get_page(url, cache_kind=cache_kind))
+        self._stop = threading.Event()
+        self._buffer = None
+
+    def _next_url(self, next_url):
+        """Builds the url of the next page from its after cursor."""
+        if not next_url:
+            return None
+        after = parse_qs(urlsplit(next_url).query).get("after")
+        if not after:
+            # Time based paging (until=...) has no cursor
+            return next_url
+        parts = urlsplit(self._base_url)
+        args = [(name, value) for name, value in parse_qsl(parts.query)
+                if name != "after"]
+        args.append(("after", after[0]))
+        return "%s://%s%s?%s" % (parts.scheme, parts.netloc, parts.path,
+                                 urllib.urlencode(args))
+
+    def _pages(self):
+        """Yields (page, next_url) fetching pages on demand."""
+        url = self.url
+        fetched = 0
+        while url and not self._stop.is_set() and (
+                self.max_pages is None or fetched < self.max_pages):
+            response = self._fetch(url)
+            if response is None:
+                return
+            page, next_url = response
+            fetched += 1
+            url = self._next_url(next_url)
+            yield page, url
+
+    def _put(self, item):
+        """Buffers item unless the iteration was stopped meanwhile."""
+        while not self._stop.is_set():
+            try:
+                self._buffer.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _producer(self):
+        try:
+            for item in self._pages():
+                self._put((item, None))
+        except Exception:
+            self._put((None, sys.exc_info()))
+            return
+        self._put((None, None))
+
+    def _prefetched_pages(self):
+        self._buffer = Queue.Queue(maxsize=self.prefetch)
+        thread = threading.Thread(target=self._producer)
+        thread.daemon = True
+        thread.start()
+        while True:
+            item, exc_info = self._buffer.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if item is None:
+                return
+            yield item
+
+    def __iter__(self):
+        pages = self._prefetched_pages() if self.prefetch > 0 \
+            else self._pages()
+        self.complete = False
+        try:
+            for page, next_url in pages:
+                if self.deadline is not None and time.time() > self.deadline:
+                    return
+                left = None
+                if self.max_items is not None:
+                    left = self.max_items - self.items_read
+                page, done, reached = _truncate_page(
+                    page, self.since, self.time_field, self.seen, left)
+                self.pages_read += 1
+                self.items_read += len(page) if isinstance(page, list) else 1
+                self.url = next_url
+                if next_url:
+                    after = parse_qs(urlsplit(next_url).query).get("after")
+                    self.cursor = after[0] if after else self.cursor
+                self.complete = reached or not next_url
+                yield page, next_url
+                if done or not next_url:
+                    return
+        finally:
+            self.close()
+
+    def close(self):
+        """Stops the prefetching thread."""
+        self._stop.set()
+        if self._buffer is not None:
+            # Unblock the producer if it is waiting on a full buffer
+            try:
+                while True:
+                    self._buffer.get_nowait()
+            except Queue.Empty:
+                pass
+
+
+class FileSlice(object):
+    """A read only file like view on length bytes of file from offset."""
+    def __init__(self, file, offset, length, name=None):
+        self.file = file
+        self.offset = offset
+        self.length = length
+        self.name = name or getattr(file, "name", None)
+        self._position = 0
+
+    def __len__(self):
+        return self.length
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=0):
+        if whence == 1:
+            position += self._position
+        elif whence == 2:
+            position += self.length
+        self._position = max(0, min(position, self.length))
+
+    def read(self, size=-1):
+        left = self.length - self._position
+        if size is None or size < 0 or size > left:
+            size = left
+        if size <= 0:
+            return ""
+        self.file.seek(self.offset + self._position)
+        data = self.file.read(size)
+        self._position += len(data)
+        return data
+
+
+def _stream_length(stream):
+    """Returns the number of bytes left to read in a file like object."""
+    if isinstance(stream, (FileSlice, mmap.mmap)):
+        return len(stream) - stream.tell()
+    try:
+        return os.fstat(stream.fileno()).st_size - stream.tell()
+    except (AttributeError, IOError, OSError):
+        position = stream.tell()
+        stream.seek(0, 2)
+        length = stream.tell() - position
+        stream.seek(position)
+        return length
+
+
+def _guess_content_type(stream, filename):
+    """Guesses the content type of a stream from its name or its data."""
+    if filename:
+        content_type = mimetypes.guess_type(filename)[0]
+        if content_type:
+            return content_type
+    position = stream.tell()
+    head = stream.read(32)
+    stream.seek(position)
+    kind = imghdr.what(None, head)
+    if kind:
+        return "image/" + kind
+    return "application/octet-stream"
+
+
+class MultipartEncoder(object):
+    """Streams a multipart/form-data body.
+
+    fields is a dict of form name -> value. Values may be strings or
+    file like objects (files, mmap objects, FileSlice, ...) which are
+    read block by block while the body is sent instead of being loaded
+    in memory. The encoder is itself a file like object whose length is
+    known beforehand, so it can be given as the body of a request with
+    a Content-Length header.
+
+    """
+    CRLF = "\r\n"
+
+    def __init__(self, fields, boundary=None):
+        # os.urandom rather than uuid, which is slow to import
+        self.boundary = boundary or os.urandom(16).encode("hex")
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        # Strings and (stream, start position, length) tuples
+        self._parts = []
+        for key, value in fields.items():
+            logging.debug("Encoding %s, (%s)" % (key, type(value)))
+            if not value:
+                continue
+            if hasattr(value, "read") and callable(value.read):
+                name = getattr(value, "name", None)
+                filename = os.path.basename(name) if name else "%s.jpg" % key
+                self._parts.append(self.CRLF.join([
+                    "--" + self.boundary,
+                    'Content-Disposition: form-data; name="%s"; '
+                    'filename="%s"' % (key, filename),
+                    "Content-Type: %s" % _guess_content_type(value, name),
+                    "", ""]))
+                self._parts.append((value, value.tell(),
+                                    _stream_length(value)))
+                self._parts.append(self.CRLF)
+            else:
+                if isinstance(value, unicode):
+                    value = value.encode("utf-8")
+                self._parts.append(self.CRLF.join([
+                    "--" + self.boundary,
+                    'Content-Disposition: form-data; name="%s"' % key,
+                    "", str(value), ""]))
+        self._parts.append("--" + self.boundary + "--" + self.CRLF)
+        self.seek(0)
+
+    def __len__(self):
+        return sum(len(part) if isinstance(part, str) else part[2]
+                   for part in self._parts)
+
+    def seek(self, position, whence=0):
+        """Rewinds the body, only seek(0) is supported."""
+        assert position == 0 and whence == 0, "Can only rewind the body"
+        self._index = 0
+        self._offset = 0
+        for part in self._parts:
+            if not isinstance(part, str):
+                part[0].seek(part[1])
+
+    def read(self, size=-1):
+        chunks = []
+        left = size if size is not None and size >= 0 else None
+        while self._index < len(self._parts) and left != 0:
+            part = self._parts[self._index]
+            if isinstance(part, str):
+                end = len(part) if left is None else \
+                    min(len(part), self._offset + left)
+                data = part[self._offset:end]
+            else:
+                stream, start, length = part
+                wanted = length - self._offset
+                if left is not None:
+                    wanted = min(wanted, left)
+                data = stream.read(wanted) if wanted > 0 else ""
+                if wanted > 0 and not data:
+                    raise IOError("%r ended before the expected length" %
+                                  stream)
+            chunks.append(data)
+            self._offset += len(data)
+            if left is not None:
+                left -= len(data)
+            part_length = len(part) if isinstance(part, str) else part[2]
+            if self._offset >= part_length:
+                self._index += 1
+                self._offset = 0
+        return "".join(chunks)
+
+
+MediaEntry = collections.namedtuple(
+    "MediaEntry", "url digest size content_type etag last_modified fetched_at")
+
+
+class MediaStore(object):
+    """A content addressed store of downloaded media.
+
+    Files are stored under root by the sha256 of their content (as in
+    root/3f/3fa4...), so that an image shared by many posts or users is
+    stored once. An sqlite index maps each URL, without its access
+    token, to the digest and the validators (ETag, Last-Modified) of its
+    last download.
+
+    """
+    def __init__(self, root):
+        self.root = root
+        self._temporary = os.path.join(root, "tmp")
+        if not os.path.isdir(self._temporary):
+            os.makedirs(self._temporary)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.db"),
+                                   check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS media ("
+                         "url TEXT PRIMARY KEY, digest TEXT, size INTEGER, "
+                         "content_type TEXT, etag TEXT, last_modified TEXT, "
+                         "fetched_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS media_digest "
+                         "ON media (digest)")
+        self._db.commit()
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def __contains__(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def lookup(self, url):
+        """Returns the MediaEntry of the last download of url, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT url, digest, size, content_type, etag, "
+                "last_modified, fetched_at FROM media WHERE url = ?",
+                (ResponseCache.key(url),)).fetchone()
+        return MediaEntry(*row) if row is not None else None
+
+    def write(self, chunks):
+        """Stores the content read from the chunks iterable.
+
+        The content is hashed while it is written to a temporary file,
+        which is then moved to its place, or removed if the store
+        already holds the same content. Returns (digest, size, new).
+
+        """
+        sha256 = hashlib.sha256()
+        size = 0
+        descriptor, temporary = tempfile.mkstemp(dir=self._temporary)
+        try:
+            with os.fdopen(descriptor, "wb") as file:
+                for chunk in chunks:
+                    sha256.update(chunk)
+                    file.write(chunk)
+                    size += len(chunk)
+            digest = sha256.hexdigest()
+            path = self.path(digest)
+            with self._lock:
+                if os.path.exists(path):
+                    os.remove(temporary)
+                    return digest, size, False
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                os.rename(temporary, path)
+            return digest, size, True
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+
+    def record(self, entry):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO media (url, digest, size, "
+                "content_type, etag, last_modified, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (ResponseCache.key(entry.url),) + tuple(entry[1:]))
+            self._db.commit()
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+
+class MediaFetcher(object):
+    """Downloads media to a MediaStore, chunk_size bytes at a time.
+
+    Memory use does not depend on the size of the files. URLs already
+    downloaded are fetched again conditionally (If-None-Match,
+    If-Modified-Since) and not downloaded if unchanged, or not at all if
+    revalidate is False. fetch_all downloads a list of URLs, each URL
+    once, on a WorkerPool of max_workers threads::
+
+       fetcher = facebook.MediaFetcher(facebook.MediaStore("media"))
+       entries = fetcher.fetch_all([post["picture"] for post in posts])
+
+    """
+    def __init__(self, store, pool=None, max_workers=4, chunk_size=65536,
+                 timeout=None, revalidate=True):
+        self.store = store
+        self.pool = _get_pool(pool)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.revalidate = revalidate
+        self.stats = {"downloaded": 0, "duplicates": 0, "not_modified": 0,
+                      "cached": 0, "bytes": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self.stats[name] += value
+
+    def statistics(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def fetch(self, url):
+        """Downloads url if needed and returns its MediaEntry."""
+        entry = self.store.lookup(url)
+        if entry is not None and entry.digest not in self.store:
+            entry = None
+        if entry is not None and not self.revalidate:
+            self._count("cached")
+            return entry
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers["If-None-Match"] = entry.etag
+            if entry.last_modified:
+                headers["If-Modified-Since"] = entry.last_modified
+        response = self.pool.urlopen("GET", url, headers=headers,
+                                     timeout=self.timeout)
+        try:
+            if response.status == 304 and entry is not None:
+                response.read()
+                self._count("not_modified")
+                entry = entry._replace(fetched_at=time.time())
+                self.store.record(entry)
+                return entry
+            if response.status >= 400:
+                error = {"error": {"message": "%d %s fetching %s" % (
+                    response.status, response.reason,
+                    ResponseCache.key(url)),
+                    "code": response.status}}
+                if response.status >= 500:
+                    raise ServerError(error)
+                raise GraphAPIError(error)
+
+            def chunks():
+                while True:
+                    chunk = response.read(self.chunk_size)
+                    if not chunk:
+                        return
+                    yield chunk
+            digest, size, new = self.store.write(chunks())
+        finally:
+            response.close()
+        self._count("downloaded" if new else "duplicates")
+        self._count("bytes", size)
+        entry = MediaEntry(url, digest, size,
+                           response.getheader("content-type"),
+                           response.getheader("etag"),
+                           response.getheader("last-modified"), time.time())
+        self.store.record(entry)
+        return entry
+
+    def fetch_all(self, urls):
+        """Fetches urls concurrently.
+
+        Returns a dict mapping each URL to its MediaEntry, or to the
+        exception raised while fetching it.
+
+        """
+        urls = list(collections.OrderedDict.fromkeys(url for url in urls
+                                                     if url))
+        workers = WorkerPool(self.max_workers)
+        try:
+            futures = [(url, workers.submit(self.fetch, url))
+                       for url in urls]
+            results = {}
+            for url, future in futures:
+                error = future.exception()
+                results[url] = error if error is not None else \
+                    future.result()
+            return results
+        finally:
+            workers.shutdown()
+
+
+class BatchOperation(dict):
+    """One operation of a Graph API batch request.
+
+    See https://developers.facebook.com/docs/graph-api/making-multiple-requests
+    The class methods mirror the GraphAPI methods, so that
+
+        graph.batch([BatchOperation.get_object("me", name="me"),
+                     BatchOperation.get_connections(
+                         "{result=me:$.id}", "friends")])
+
+    fetches the active user and its friends in a single round trip.
+    Operations can also be given as plain dicts in Facebook's format.
+
+    """
+    def __init__(self, method, relative_url, body=None, name=None,
+                 depends_on=None, **kwargs):
+        super(BatchOperation, self).__init__(method=method,
+                                             relative_url=relative_url,
+                                             **kwargs)
+        if body:
+            if not isinstance(body, basestring):
+                body = urllib.urlencode(body)
+            self["body"] = body
+        if name:
+            self["name"] = name
+        if depends_on:
+            self["depends_on"] = depends_on
+
+    @staticmethod
+    def _relative_url(path, args):
+        if args:
+            return path + "?" + urllib.urlencode(args)
+        return path
+
+    @classmethod
+    def get_object(cls, id, name=None, depends_on=None, **args):
+        return cls("GET", cls._relative_url(id, args), name=name,
+                   depends_on=depends_on)
+
+    @classmethod
+    def get_objects(cls, ids, name=None, depends_on=None, **args):
+        args["ids"] = ",".join(ids)
+        return cls("GET", cls._relative_url("", args), name=name,
+                   depends_on=depends_on)
+
+    @classmethod
+    def get_connections(cls, id, connection_name, name=None,
+                        depends_on=None, **args):
+        return cls("GET", cls._relative_url(id + "/" + connection_name, args),
+                   name=name, depends_on=depends_on)
+
+    @classmethod
+    def put_object(cls, parent_object, connection_name, name=None,
+                   depends_on=None, **data):
+        return cls("POST", parent_object + "/" + connection_name, body=data,
+                   name=name, depends_on=depends_on)
+
+    @classmethod
+    def delete_object(cls, id, name=None, depends_on=None):
+        return cls("DELETE", id, name=name, depends_on=depends_on)
+
+    def references(self):
+        """Returns the names of the operations this one depends on."""
+        names = set()
+        if self.get("depends_on"):
+            names.add(self["depends_on"])
+        for value in (self.get("relative_url"), self.get("body")):
+            if value:
+                value = urllib.unquote_plus(value)
+                names.update(_BATCH_REFERENCE.findall(value))
+        return names
+
+
+_BATCH_REFERENCE = re.compile(r"\{result=([^:}]+):")
 
 
 class GraphAPI(object):
@@ -90,14 +1905,160 @@ class GraphAPI(object):
     for the active user from the cookie saved by the SDK.
 
     """
+    # Maximum number of operations Facebook accepts in a batch request
+    BATCH_SIZE = 50
+
+    # Error codes Facebook sends when the application, a user or a page
+    # is making too many calls
+    THROTTLING_CODES = (4, 17, 32, 613)
+
+    # Headers reporting the percentage of the call quota used
+    USAGE_HEADERS = ("x-app-usage", "x-page-usage")
+
+    HOOK_EVENTS = ("request_start", "request_end", "request_error")
+
+    # Bytes read at a time from an image response
+    MEDIA_CHUNK_SIZE = 65536
+
     def __init__(self, access_token=None, timeout=None, *args, **kwargs):
-        self.access_token = access_token
+        # Optional TokenManager providing (and refreshing) the token
+        self.token_manager = kwargs.pop("token_manager", None)
+        self._access_token = None
+        if access_token is not None or self.token_manager is None:
+            self.access_token = access_token
         self.timeout = timeout
-        self.max_pages = kwargs.pop("max_pages", 3)
+        # No page limit by default, see Paginator for the other ways of
+        # ending the iteration over a connection
+        self.max_pages = kwargs.pop("max_pages", None)
+        # Number of pages Paginator fetches ahead of the caller
+        self.prefetch = kwargs.pop("prefetch", 2)
+        # Optional ResponseCache for get_object/get_objects/get_connections
+        self.cache = kwargs.pop("cache", None)
+        # Optional MediaStore the images sent back (a picture for instance)
+        # are streamed to, see _read_image
+        self.media_store = kwargs.pop("media_store", None)
+        # Token bucket shared by every request, pass rate_limiter=False to
+        # disable it
+        self.rate_limiter = kwargs.pop("rate_limiter", None)
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter()
+        # Keep-alive connections shared by every request of this client,
+        # or any transport with the same urlopen method (see Cassette)
+        self.pool = kwargs.pop("transport", None) or kwargs.pop(
+            "pool", None) or ConnectionPool(
+            maxsize=kwargs.pop("pool_maxsize", 10),
+            idle_timeout=kwargs.pop("pool_idle_timeout", 60))
+        # Request hooks by event, see add_hook
+        self._hooks = {}
+
+    @property
+    def access_token(self):
+        if self.token_manager is not None:
+            return self.token_manager.get_token()
+        return self._access_token
+
+    @access_token.setter
+    def access_token(self, access_token):
+        if self.token_manager is not None:
+            self.token_manager.set_token(access_token)
+        else:
+            self._access_token = access_token
+
+    def pool_statistics(self):
+        """Returns the statistics of the underlying connection pool."""
+        return self.pool.statistics()
+
+    def add_hook(self, event, hook):
+        """Calls hook(event, info) on each event of the Graph API requests.
+
+        event is "request_start", "request_end" or "request_error". info
+        is a dict holding the method, path, status, bytes (received,
+        before decompression), latency (in seconds), retries (the
+        RetryPolicy attempt, 0 for the first one), cache ("hit",
+        "revalidated", "miss" or None) and pool ("reused" or "new") of
+        the request, plus the error raised for request_error. Hooks are
+        called from the thread sending the request; requests sent while
+        no hook is registered are not instrumented at all.
+
+        """
+        if event not in self.HOOK_EVENTS:
+            raise ValueError("Unknown hook event %r" % event)
+        self._hooks.setdefault(event, []).append(hook)
+
+    def remove_hook(self, event, hook):
+        hooks = self._hooks.get(event, [])
+        if hook in hooks:
+            hooks.remove(hook)
+        if not hooks:
+            self._hooks.pop(event, None)
+
+    def _call_hooks(self, event, info):
+        for hook in self._hooks.get(event, ()):
+            try:
+                hook(event, info)
+            except Exception:
+                logging.exception("Request hook %r failed" % hook)
+
+    def _urlopen(self, method, url, body=None, headers=None, timeout=None):
+        """Sends a request through the rate limiter and the pool."""
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        response = self.pool.urlopen(method, url, body, headers,
+                                     timeout=timeout or self.timeout)
+        if self.rate_limiter:
+            usage = None
+            for header in self.USAGE_HEADERS:
+                value = response.getheader(header)
+                if value:
+                    try:
+                        usage = max([usage or 0] +
+                                    list(_parse_json(value).values()))
+                    except (ValueError, AttributeError, TypeError):
+                        pass
+            if usage is not None:
+                self.rate_limiter.report_usage(usage)
+            elif response.status < 400:
+                self.rate_limiter.success()
+        return response
+
+    def _raise_error(self, response, status=None):
+        """Raises the GraphAPIError matching a decoded error response.
+
+        Throttling errors slow the rate limiter down before raising, and
+        unknown errors of 5xx responses are raised as ServerError so that
+        they are retried like the other server side errors.
+
+        """
+        error = response.get("error") if isinstance(response, dict) else None
+        if not isinstance(error, dict):
+            if status >= 500:
+                raise ServerError(response)
+            raise GraphAPIError(response)
+        if error.get("code") in self.THROTTLING_CODES and self.rate_limiter:
+            self.rate_limiter.throttled()
+        exception = raise_error(response)
+        if exception is GraphAPIError and status >= 500:
+            exception = ServerError
+        raise exception(response)
+
+    def _read_error(self, file):
+        """Decodes the body of an error response, JSON or not."""
+        body = file.read()
+        try:
+            return _parse_json(body)
+        except ValueError:
+            # Proxies and load balancers answer 5xx with HTML pages
+            return body
 
     def get_object(self, id, **args):
-        """Fetchs the given object from the graph."""
-        return self.request(id, args)
+        """Fetchs the given object from the graph.
+
+        cache_kind is the type of the object ("user", "group", ...) used
+        to pick its time to live when a ResponseCache is set.
+
+        """
+        cache_kind = args.pop("cache_kind", "object")
+        return self.request(id, args, cache_kind=cache_kind)
 
     def get_objects(self, ids, **args):
         """Fetchs all of the given object from the graph.
@@ -105,15 +2066,37 @@ class GraphAPI(object):
         We return a map from ID to object. If any of the IDs are
         invalid, we raise an exception.
         """
+        cache_kind = args.pop("cache_kind", "objects")
         args["ids"] = ",".join(ids)
-        return self.request("", args)
+        return self.request("", args, cache_kind=cache_kind)
 
     def get_connections(self, id, connection_name, **args):
-        """Fetchs the connections for given object."""
+        """Fetchs the connections for given object.
+
+        as_generator=True returns a Paginator of (page, next_url); the
+        prefetch, max_items, deadline, time_field and seen arguments are
+        given to it (since and after are also sent to Facebook). stream=True
+        returns a PageStream yielding the items of every page while they
+        are decoded from the socket.
+
+        """
         as_generator = args.pop("as_generator", False)
+        cache_kind = args.pop("cache_kind", connection_name)
+        if args.pop("stream", False):
+            url, post_data = self.prepare_url_with_post_data(
+                id + "/" + connection_name, args)
+            return PageStream(self, url, self.max_pages)
         if as_generator:
-            return self._paginator(id + "/" + connection_name, args)
-        return self.request(id + "/" + connection_name, args)
+            options = dict((name, args.pop(name))
+                           for name in ("prefetch", "max_items", "deadline",
+                                        "time_field", "seen")
+                           if name in args)
+            if "since" in args:
+                options["since"] = args["since"]
+            return self._paginator(id + "/" + connection_name, args,
+                                   cache_kind=cache_kind, **options)
+        return self.request(id + "/" + connection_name, args,
+                            cache_kind=cache_kind)
 
     def put_object(self, parent_object, connection_name, **data):
         """Writes the given object to the graph, connected to the given parent.
@@ -174,26 +2157,139 @@ class GraphAPI(object):
         """Deletes the object with the given ID from the graph."""
         self.request(id, post_args={"method": "delete"})
 
+    def batch(self, operations, parallel=False, max_workers=4):
+        """Runs several operations through the Graph API batch endpoint.
+
+        operations is a list of BatchOperation (or dicts in Facebook's
+        batch format). They are sent up to BATCH_SIZE per round trip;
+        operations tied together by depends_on or JSONPath references
+        ("{result=name:$.id}") are kept in the same round trip. With
+        parallel=True, round trips run concurrently on max_workers
+        threads.
+
+        Returns a list with, for each operation in order, either its
+        decoded result, None if Facebook did not return any (failed
+        dependency or omit_response_on_success) or a GraphAPIError
+        instance mapped through raise_error. Errors are returned, not
+        raised, so that one failing operation does not hide the others.
+
+        """
+        operations = [BatchOperation(**operation)
+                      if not isinstance(operation, BatchOperation)
+                      else operation for operation in operations]
+        chunks = self._batch_chunks(operations)
+
+        def run(chunk):
+            return self._batch_request([operations[i] for i in chunk])
+
+        if parallel and len(chunks) > 1:
+            workers = WorkerPool(min(max_workers, len(chunks)))
+            try:
+                responses = workers.map(run, chunks)
+            finally:
+                workers.shutdown(wait=False)
+        else:
+            responses = [run(chunk) for chunk in chunks]
+
+        results = [None] * len(operations)
+        for chunk, response in zip(chunks, responses):
+            for index, result in zip(chunk, response):
+                results[index] = result
+        return results
+
+    def _batch_chunks(self, operations):
+        """Splits operations into lists of indexes of at most BATCH_SIZE.
+
+        Operations referencing each other end up in the same chunk, in
+        their original order.
+
+        """
+        names = dict((operation["name"], i)
+                     for i, operation in enumerate(operations)
+                     if operation.get("name"))
+        # Union find over the operations linked by a reference
+        parents = range(len(operations))
+
+        def find(i):
+            while parents[i] != i:
+                parents[i] = parents[parents[i]]
+                i = parents[i]
+            return i
+
+        for i, operation in enumerate(operations):
+            for name in operation.references():
+                if name not in names:
+                    raise ValueError("Unknown batch operation name %r" % name)
+                parents[find(i)] = find(names[name])
+
+        groups = {}
+        ordered = []
+        for i in range(len(operations)):
+            root = find(i)
+            if root not in groups:
+                groups[root] = []
+                ordered.append(groups[root])
+            groups[root].append(i)
+
+        chunks = []
+        chunk = []
+        for group in ordered:
+            if len(group) > self.BATCH_SIZE:
+                raise ValueError("%d dependent operations do not fit in a "
+                                 "batch of %d" % (len(group), self.BATCH_SIZE))
+            if len(chunk) + len(group) > self.BATCH_SIZE:
+                chunks.append(sorted(chunk))
+                chunk = []
+            chunk.extend(group)
+        if chunk:
+            chunks.append(sorted(chunk))
+        return chunks
+
+    def _batch_request(self, operations):
+        """Sends one batch round trip and decodes each operation result."""
+        response = self.request("", post_args={
+            "batch": json.dumps(operations),
+            "include_headers": "false",
+        })
+        results = []
+        for item in response:
+            if item is None:
+                results.append(None)
+                continue
+            try:
+                body = _parse_json(item.get("body") or "null")
+            except ValueError:
+                body = item.get("body")
+            if isinstance(body, dict) and body.get("error"):
+                if (body["error"].get("code") in self.THROTTLING_CODES and
+                        self.rate_limiter):
+                    self.rate_limiter.throttled()
+                body = raise_error(body)(body)
+            elif item.get("code", 200) >= 400:
+                body = GraphAPIError(body)
+            results.append(body)
+        return results
+
+    def bulk_writer(self, max_workers=4):
+        """Returns a BulkWriter sending queued writes in batches."""
+        return BulkWriter(self, max_workers)
+
     def delete_request(self, user_id, request_id):
         """Deletes the Request with the given ID for the given user."""
-        conn = httplib.HTTPSConnection('graph.facebook.com')
-
-        url = '/%s_%s?%s' % (
+        url = 'https://graph.facebook.com/%s_%s?%s' % (
             request_id,
             user_id,
             urllib.urlencode({'access_token': self.access_token}),
         )
-        conn.request('DELETE', url)
-        response = conn.getresponse()
-        data = response.read()
-
-        response = _parse_json(data)
-        # Raise an error if we got one, but don't not if Facebook just
-        # gave us a Bool value
-        if (response and isinstance(response, dict) and response.get("error")):
-            raise raise_error(response), response
+        def fetch(info):
+            response = _parse_json(self._read(info, 'DELETE', url))
+            # Raise an error if we got one, but don't not if Facebook just
+            # gave us a Bool value
+            if (response and isinstance(response, dict) and
+                    response.get("error")):
+                raise raise_error(response), response
 
-        conn.close()
+        self._instrumented('DELETE', url, fetch)
 
     def put_photo(self, image, message=None, album_id=None, **kwargs):
         """Uploads an image using multipart/form-data.
@@ -205,39 +2301,83 @@ class GraphAPI(object):
 
         """
         object_id = album_id or "me"
-        #it would have been nice to reuse self.request;
-        #but multipart is messy in urllib
         post_args = {
-            'access_token': self.access_token,
             'source': image,
             'message': message,
         }
         post_args.update(kwargs)
-        content_type, body = self._encode_multipart_form(post_args)
-        req = urllib2.Request(("https://graph.facebook.com/%s/photos" %
-                               object_id),
-                              data=body)
-        req.add_header('Content-Type', content_type)
-        try:
-            data = urllib2.urlopen(req).read()
-        #For Python 3 use this:
-        #except urllib2.HTTPError as e:
-        except urllib2.HTTPError, e:
-            data = e.read()  # Facebook sends OAuth errors as 400, and urllib2
-                             # throws an exception, we want a GraphAPIError
-        try:
-            response = _parse_json(data)
+        return self._post_multipart(
+            "https://graph.facebook.com/%s/photos" % object_id, post_args)
+
+    def put_video(self, video, profile_id="me", retry_policy=None, **kwargs):
+        """Uploads a video with Facebook's resumable upload protocol.
+
+        video=Seekable file like object (file, mmap, ...) for the video
+        profile_id=Profile, page or group receiving the video
+        kwargs (title, description, ...) are sent with the last phase.
+
+        The video is sent in the chunks Facebook asks for, each one
+        streamed from the file and retried on its own by retry_policy
+        (a RetryPolicy). Facebook hands out the offset of the next chunk
+        once the previous one is received, so chunks are sent in order.
+        See https://developers.facebook.com/docs/graph-api/video-uploads
+
+        """
+        url = "https://graph-video.facebook.com/%s/videos" % profile_id
+        retry_policy = retry_policy or RetryPolicy()
+        origin = video.tell()
+        session = self._post_multipart(url, {
+            "upload_phase": "start",
+            "file_size": str(_stream_length(video)),
+        })
+        session_id = session["upload_session_id"]
+        start = int(session["start_offset"])
+        end = int(session["end_offset"])
+        while start < end:
+            def transfer(start=start, end=end):
+                chunk = FileSlice(video, origin + start, end - start)
+                return self._post_multipart(url, {
+                    "upload_phase": "transfer",
+                    "upload_session_id": session_id,
+                    "start_offset": str(start),
+                    "video_file_chunk": chunk,
+                })
+            response = retry_policy.call(transfer)
+            start = int(response["start_offset"])
+            end = int(response["end_offset"])
+        kwargs.update(upload_phase="finish", upload_session_id=session_id)
+        response = self._post_multipart(url, kwargs)
+        if isinstance(response, dict):
+            response.setdefault("video_id", session.get("video_id"))
+        return response
+
+    def _post_multipart(self, url, fields):
+        """POSTs fields as a streamed multipart/form-data body."""
+        fields = dict(fields)
+        if self.access_token:
+            fields["access_token"] = self.access_token
+        body = MultipartEncoder(fields)
+
+        def fetch(info):
+            # Facebook sends OAuth errors as 400, the pool hands us the
+            # body whatever the status is so we can raise a GraphAPIError
+            data = self._read(info, 'POST', url, body, {
+                'Content-Type': body.content_type,
+                'Content-Length': str(len(body)),
+            })
+            try:
+                response = _parse_json(data)
+            except ValueError:
+                return data
             # Raise an error if we got one, but don't not if Facebook just
             # gave us a Bool value
             if (response and isinstance(response, dict) and
                     response.get("error")):
-                raise raise_error(response), response
-        except ValueError:
-            response = data
+                self._raise_error(response)
+            return response
 
-        return response
+        return self._instrumented('POST', url, fetch)
 
-    # based on: http://code.activestate.com/recipes/146306/
     def _encode_multipart_form(self, fields):
         """Encode files as 'multipart/form-data'.
 
@@ -246,36 +2386,11 @@ class GraphAPI(object):
         name will be chosen.
 
         Returns (content_type, body) ready for httplib.HTTP instance.
+        This loads the whole body in memory, MultipartEncoder streams it.
 
         """
-        BOUNDARY = '----------ThIs_Is_tHe_bouNdaRY_$'
-        CRLF = '\r\n'
-        L = []
-        for (key, value) in fields.items():
-            logging.debug("Encoding %s, (%s)%s" % (key, type(value), value))
-            if not value:
-                continue
-            L.append('--' + BOUNDARY)
-            if hasattr(value, 'read') and callable(value.read):
-                filename = getattr(value, 'name', '%s.jpg' % key)
-                L.append(('Content-Disposition: form-data;'
-                          'name="%s";'
-                          'filename="%s"') % (key, filename))
-                L.append('Content-Type: image/jpeg')
-                value = value.read()
-                logging.debug(type(value))
-            else:
-                L.append('Content-Disposition: form-data; name="%s"' % key)
-            L.append('')
-            if isinstance(value, unicode):
-                logging.debug("Convert to ascii")
-                value = value.encode('ascii')
-            L.append(value)
-        L.append('--' + BOUNDARY + '--')
-        L.append('')
-        body = CRLF.join(L)
-        content_type = 'multipart/form-data; boundary=%s' % BOUNDARY
-        return content_type, body
+        encoder = MultipartEncoder(fields)
+        return encoder.content_type, encoder.read()
 
     def prepare_url_with_post_data(self, path, args=None, post_args=None):
         """Prepare a Graph API URL with the given path and arguments"""
@@ -292,68 +2407,241 @@ class GraphAPI(object):
 
         return url, post_data
 
-    def _paginator(self, path, args=None):
+    def _paginator(self, path, args=None, cache_kind=None, **options):
         """Creates a paginator with the given path in the Graph API."""
-        url, post_data = self.prepare_url_with_post_data(path, args)
-        pages_read = 0
-        while url and pages_read < self.max_pages:
-            api_responses, url = self._raw_request(url)
-            pages_read += 1
-            yield api_responses, url
-        return
-
-    def request(self, path, args=None, post_args=None):
+        options.setdefault("prefetch", self.prefetch)
+        options.setdefault("max_pages", self.max_pages)
+        return Paginator(self, path, args, cache_kind=cache_kind, **options)
+
+    def get_page(self, url, cache_kind=None):
+        """Fetches a page of a connection given its paging url.
+
+        Returns (data, next_url), next_url being None on the last page.
+
+        """
+        return self._raw_request(url, cache_kind=cache_kind)
+
+    def request(self, path, args=None, post_args=None, cache_kind=None):
         """Fetches the given path in the Graph API.
 
         We translate args to a valid query string. If post_args is
         given, we send a POST request to the given path with the given
-        arguments.
+        arguments. GET requests given a cache_kind go through self.cache
+        if it is set.
 
         """
         url, post_data = self.prepare_url_with_post_data(path, args, post_args)
-        response, next_url = self._raw_request(url, post_data)
+        response, next_url = self._raw_request(url, post_data, cache_kind)
         return response
 
-    def _raw_request(self, url, post_data=None):
+    _TOKEN_ARG = re.compile(r"(?<=[?&])access_token=[^&]*")
+
+    def _current_token(self, url, post_data=None):
+        """Replaces the access token of url and post_data by the current one.
+
+        Paging URLs, and the ones a Paginator builds its pages from, keep
+        the token they were made with. It may have been refreshed since.
+
+        """
+        token = self.access_token
+        if token:
+            arg = "access_token=" + urllib.quote_plus(token)
+            url = self._TOKEN_ARG.sub(arg, url)
+            if post_data and isinstance(post_data, basestring):
+                post_data = self._TOKEN_ARG.sub(arg, "?" + post_data)[1:]
+        return url, post_data
+
+    def _raw_request(self, url, post_data=None, cache_kind=None):
         """Fetches the given raw Graph API URL.
 
-        Perform HTTP request with the given URL and POST data, if any.
+        Perform HTTP request with the given URL and POST data, if any,
+        sent with the current access token.
         """
+        url, post_data = self._current_token(url, post_data)
+        return self._instrumented(
+            "GET" if post_data is None else "POST", url,
+            lambda info: self._fetch(url, post_data, cache_kind, info))
+
+    def _instrumented(self, method, url, fetch):
+        """Returns fetch(info), firing the request hooks around it.
+
+        fetch sends one request and fills the status, bytes, cache and
+        pool of info, which is None when no hook is registered so that
+        requests cost nothing more then.
+
+        """
+        if not self._hooks:
+            return fetch(None)
+        info = {
+            "method": method,
+            "path": urlsplit(url).path,
+            "status": None,
+            "bytes": 0,
+            "latency": None,
+            "retries": getattr(_retry_state, "attempt", 0),
+            "cache": None,
+            "pool": None,
+        }
+        self._call_hooks("request_start", info)
+        started = time.time()
         try:
-            file = urllib2.urlopen(url, post_data, timeout=self.timeout)
-        except urllib2.HTTPError, e:
-            response = _parse_json(e.read())
-            raise GraphAPIError(response)
-        except TypeError:
-            # Timeout support for Python <2.6
-            if self.timeout:
-                socket.setdefaulttimeout(self.timeout)
-            file = urllib2.urlopen(url, post_data)
+            result = fetch(info)
+        except Exception, e:
+            info["latency"] = time.time() - started
+            info["error"] = e
+            self._call_hooks("request_error", info)
+            raise
+        info["latency"] = time.time() - started
+        self._call_hooks("request_end", info)
+        return result
+
+    def _read(self, info, method, url, body=None, headers=None):
+        """Sends a request and returns its whole body, filling info."""
+        file = self._urlopen(method, url, body, headers, timeout=self.timeout)
+        if info is not None:
+            info["status"] = file.status
+            info["pool"] = "reused" if file.reused else "new"
+        try:
+            return _read_response(file)
+        finally:
+            if info is not None:
+                info["bytes"] = file.bytes_received
+
+    def _fetch(self, url, post_data=None, cache_kind=None, info=None):
+        """Performs the request of _raw_request, filling info if given."""
+        cache = None
+        entry = None
+        headers = {}
+        if self.cache is not None and post_data is None and cache_kind:
+            cache = self.cache
+            entry = cache.lookup(url)
+            if entry is not None and cache.is_fresh(entry):
+                cache.count("hits")
+                if info is not None:
+                    info["cache"] = "hit"
+                return self._unpack_response(_parse_json(entry.body))
+            if entry is not None and entry.etag:
+                headers["If-None-Match"] = entry.etag
+
+        if post_data is None:
+            file = self._urlopen("GET", url, headers=headers,
+                                     timeout=self.timeout)
+        else:
+            file = self._urlopen(
+                "POST", url, post_data,
+                {"Content-Type": "application/x-www-form-urlencoded"},
+                timeout=self.timeout)
+        if info is not None:
+            info["status"] = file.status
+            info["pool"] = "reused" if file.reused else "new"
+            if cache is not None:
+                info["cache"] = "miss"
         try:
+            if file.status == 304 and entry is not None:
+                file.read()
+                cache.revalidate(url, entry)
+                if info is not None:
+                    info["cache"] = "revalidated"
+                response = _parse_json(entry.body)
+                return self._unpack_response(response)
+            if file.status >= 400:
+                self._raise_error(self._read_error(file), file.status)
             fileInfo = file.info()
             if fileInfo.maintype == 'text':
-                response = _parse_json(file.read())
+                body = file.read()
+                response = _parse_json(body)
+                if cache is not None:
+                    cache.count("misses")
+                    if (isinstance(response, dict) and
+                            not response.get("error")):
+                        if cache_kind == "object":
+                            cache_kind = response.get("metadata", {}).get(
+                                "type", cache_kind)
+                        cache.store(url, body, file.getheader("etag"),
+                                    cache_kind)
             elif fileInfo.maintype == 'image':
-                mimetype = fileInfo['content-type']
-                response = {
-                    "data": file.read(),
-                    "mime-type": mimetype,
-                    "url": file.url,
-                }
+                response = self._read_image(file, fileInfo['content-type'])
             else:
                 raise raise_error('Maintype was not text or image')
         finally:
             file.close()
+            if info is not None:
+                info["bytes"] = file.bytes_received
         if response and isinstance(response, dict) and response.get("error"):
-            raise GraphAPIError(response["error"]["type"],
-                                response["error"]["message"])
+            self._raise_error(response)
+
+        return self._unpack_response(response)
+
+    def _read_image(self, file, mimetype):
+        """Reads an image response without holding it in memory.
 
+        The image is read MEDIA_CHUNK_SIZE bytes at a time. With a
+        media_store, it is written to the store and the response gives
+        its digest, size and path. Otherwise the response (unpacked from
+        "data") is a temporary file holding the image, at its start.
+
+        """
+        def chunks():
+            while True:
+                chunk = file.read(self.MEDIA_CHUNK_SIZE)
+                if not chunk:
+                    return
+                yield chunk
+        if self.media_store is not None:
+            digest, size, _ = self.media_store.write(chunks())
+            self.media_store.record(MediaEntry(
+                file.url, digest, size, mimetype, file.getheader("etag"),
+                file.getheader("last-modified"), time.time()))
+            return {"digest": digest, "size": size,
+                    "path": self.media_store.path(digest),
+                    "mime-type": mimetype, "url": file.url}
+        data = tempfile.TemporaryFile()
+        try:
+            for chunk in chunks():
+                data.write(chunk)
+            data.seek(0)
+        except BaseException:
+            data.close()
+            raise
+        return {"data": data, "mime-type": mimetype, "url": file.url}
+
+    def _unpack_response(self, response):
+        """Returns (data, next_url) of a decoded Graph API response."""
+        if not isinstance(response, dict):
+            # Batch requests and some writes do not return an object
+            return response, None
         next_url = response.get('paging', {}).get('next')
         data = response.get('data')
         if data is not None:
             response = data
         return response, next_url
 
+    def _stream_request(self, url):
+        """Fetches a Graph API page and returns it as a StreamedPage.
+
+        The request hooks see the request end once the headers of the
+        page are received, its body being decoded afterwards.
+
+        """
+        url, post_data = self._current_token(url)
+
+        def fetch(info):
+            file = self._urlopen("GET", url, timeout=self.timeout)
+            if info is not None:
+                info["status"] = file.status
+                info["pool"] = "reused" if file.reused else "new"
+            if file.status >= 400 or file.info().maintype != 'text':
+                try:
+                    response = self._read_error(file)
+                finally:
+                    file.close()
+                    if info is not None:
+                        info["bytes"] = file.bytes_received
+                self._raise_error(response, file.status)
+            return StreamedPage(file)
+
+        return self._instrumented("GET", url, fetch)
+
     def fql(self, query, args=None, post_args=None):
         """FQL query.
 
@@ -381,30 +2669,24 @@ class GraphAPI(object):
 
         args["format"] = "json"
 
-        try:
-            file = urllib2.urlopen("https://api.facebook.com/method/" +
-                                   fql_method + "?" + urllib.urlencode(args),
-                                   post_data, timeout=self.timeout)
-        except TypeError:
-            # Timeout support for Python <2.6
-            if self.timeout:
-                socket.setdefaulttimeout(self.timeout)
-            file = urllib2.urlopen("https://api.facebook.com/method/" +
-                                   fql_method + "?" + urllib.urlencode(args),
-                                   post_data)
+        url = ("https://api.facebook.com/method/" + fql_method + "?" +
+               urllib.urlencode(args))
+        method = "GET" if post_data is None else "POST"
 
-        try:
-            content = file.read()
+        def fetch(info):
+            if post_data is None:
+                content = self._read(info, method, url)
+            else:
+                content = self._read(
+                    info, method, url, post_data,
+                    {"Content-Type": "application/x-www-form-urlencoded"})
             response = _parse_json(content)
             #Return a list if success, return a dictionary if failed
             if type(response) is dict and "error_code" in response:
                 raise raise_error(response), response
-        except Exception, e:
-            raise e
-        finally:
-            file.close()
+            return response
 
-        return response
+        return self._instrumented(method, url, fetch)
 
     def extend_access_token(self, app_id, app_secret):
         """
@@ -419,18 +2701,231 @@ class GraphAPI(object):
             "grant_type": "fb_exchange_token",
             "fb_exchange_token": self.access_token,
         }
-        response = urllib.urlopen("https://graph.facebook.com/oauth/"
-                                  "access_token?" +
-                                  urllib.urlencode(args)).read()
-        query_str = parse_qs(response)
-        if "access_token" in query_str:
-            result = {"access_token": query_str["access_token"][0]}
-            if "expires" in query_str:
-                result["expires"] = query_str["expires"][0]
-            return result
-        else:
-            response = json.loads(response)
-            raise raise_error(response), response
+        url = ("https://graph.facebook.com/oauth/access_token?" +
+               urllib.urlencode(args))
+
+        def fetch(info):
+            response = self._read(info, "GET", url)
+            query_str = parse_qs(response)
+            if "access_token" in query_str:
+                result = {"access_token": query_str["access_token"][0]}
+                if "expires" in query_str:
+                    result["expires"] = query_str["expires"][0]
+                return result
+            else:
+                response = json.loads(response)
+                raise raise_error(response), response
+
+        return self._instrumented("GET", url, fetch)
+
+
+class AsyncGraphAPI(GraphAPI):
+    """A GraphAPI client whose calls run concurrently and return Futures.
+
+    Every call is run on a WorkerPool of max_concurrency threads, which
+    bounds the number of requests in flight for the whole client, and
+    requests to a given host are further bounded by max_per_host. The
+    same exceptions as GraphAPI are raised by Future.result():
+
+       graph = facebook.AsyncGraphAPI(access_token, max_concurrency=200)
+       futures = [graph.get_object(id) for id in ids]
+       objects = [future.result() for future in futures]
+
+    get_connections(..., as_generator=True) yields one Future per page;
+    the next page is requested as soon as the previous one arrives, not
+    when the caller asks for it.
+
+    """
+    def __init__(self, access_token=None, timeout=None, max_concurrency=100,
+                 max_per_host=20, *args, **kwargs):
+        kwargs.setdefault("pool_maxsize", max_per_host)
+        super(AsyncGraphAPI, self).__init__(access_token, timeout, *args,
+                                            **kwargs)
+        self.max_per_host = max_per_host
+        self.workers = WorkerPool(max_concurrency)
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+
+    def _host_limit(self, url):
+        host = urlsplit(url).hostname
+        with self._host_lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.max_per_host)
+            return self._host_limits[host]
+
+    def _raw_request(self, url, post_data=None, cache_kind=None):
+        with self._host_limit(url):
+            return super(AsyncGraphAPI, self)._raw_request(url, post_data,
+                                                           cache_kind)
+
+    def _fql(self, query, args=None, post_args=None):
+        with self._host_limit("https://api.facebook.com/"):
+            return super(AsyncGraphAPI, self).fql(query, args, post_args)
+
+    def _extend_access_token(self, app_id, app_secret):
+        with self._host_limit("https://graph.facebook.com/"):
+            return super(AsyncGraphAPI, self).extend_access_token(app_id,
+                                                                  app_secret)
+
+    def get_object(self, id, **args):
+        return self.workers.submit(super(AsyncGraphAPI, self).get_object,
+                                   id, **args)
+
+    def get_objects(self, ids, **args):
+        return self.workers.submit(super(AsyncGraphAPI, self).get_objects,
+                                   ids, **args)
+
+    def get_connections(self, id, connection_name, **args):
+        if args.get("as_generator"):
+            return super(AsyncGraphAPI, self).get_connections(
+                id, connection_name, **args)
+        return self.workers.submit(
+            super(AsyncGraphAPI, self).get_connections, id, connection_name,
+            **args)
+
+    def put_object(self, parent_object, connection_name, **data):
+        return self.workers.submit(super(AsyncGraphAPI, self).put_object,
+                                   parent_object, connection_name, **data)
+
+    def fql(self, query, args=None, post_args=None):
+        return self.workers.submit(self._fql, query, args, post_args)
+
+    def extend_access_token(self, app_id, app_secret):
+        return self.workers.submit(self._extend_access_token, app_id,
+                                   app_secret)
+
+    def _paginator(self, path, args=None, cache_kind=None, max_pages=None,
+                   max_items=None, deadline=None, since=None,
+                   time_field="created_time", after=None, seen=None,
+                   **options):
+        """Yields a Future of (page, next_url) for each page of path.
+
+        The options of Paginator end the iteration the same way, except
+        prefetch: the next page is always requested as soon as the
+        previous one arrives.
+
+        """
+        args = dict(args or {})
+        if after:
+            args["after"] = after
+        url, post_data = self.prepare_url_with_post_data(path, args)
+        if max_pages is None:
+            max_pages = self.max_pages
+        since = _timestamp(since) if since is not None else None
+        seen = frozenset(seen or ())
+        # Pages are fetched one after the other, so the count of items is
+        # only updated by one thread at a time
+        items_read = [0]
+
+        def get_page(url):
+            page, next_url = self._raw_request(url, cache_kind=cache_kind)
+            left = None
+            if max_items is not None:
+                left = max_items - items_read[0]
+            page, done, _ = _truncate_page(page, since, time_field, seen,
+                                           left)
+            items_read[0] += len(page) if isinstance(page, list) else 1
+            if done or (deadline is not None and time.time() > deadline):
+                next_url = None
+            return page, next_url
+
+        pages = Queue.Queue()
+
+        def fetch(url, pages_read):
+            future = self.workers.submit(get_page, url)
+            pages.put(future)
+
+            def chain(future):
+                if future.exception() is None:
+                    response, next_url = future.result()
+                    if next_url and (max_pages is None or
+                                     pages_read + 1 < max_pages):
+                        fetch(next_url, pages_read + 1)
+                        return
+                pages.put(None)
+            future.add_done_callback(chain)
+
+        fetch(url, 0)
+        while True:
+            future = pages.get()
+            if future is None:
+                return
+            yield future
+
+    def close(self):
+        """Stops the worker threads and closes the idle connections."""
+        self.workers.shutdown()
+        self.pool.clear()
+
+
+class BulkWriter(object):
+    """Queues writes and sends them as concurrent batch requests.
+
+       writer = graph.bulk_writer(max_workers=4)
+       for post_id in post_ids:
+           writer.put_comment(post_id, "First!")
+           writer.put_like(post_id)
+       results = writer.flush()
+
+    flush() returns, for each queued write in order, its result or the
+    GraphAPIError it failed with. Writes to the same parent object are
+    applied in the order they were queued: the n-th writes of every
+    parent are sent together, in batches of up to GraphAPI.BATCH_SIZE
+    running on max_workers threads, once the (n-1)-th are done.
+
+    """
+    def __init__(self, graph, max_workers=4):
+        self.graph = graph
+        self.max_workers = max_workers
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def _queue(self, parent, operation):
+        self._writes.append((parent, operation))
+        return len(self._writes) - 1
+
+    def put_object(self, parent_object, connection_name, **data):
+        """Queues a write, returns its index in the results of flush()."""
+        return self._queue(parent_object, BatchOperation.put_object(
+            parent_object, connection_name, **data))
+
+    def put_wall_post(self, message, attachment={}, profile_id="me"):
+        return self.put_object(profile_id, "feed", message=message,
+                               **attachment)
+
+    def put_comment(self, object_id, message):
+        return self.put_object(object_id, "comments", message=message)
+
+    def put_like(self, object_id):
+        return self.put_object(object_id, "likes")
+
+    def delete_object(self, id):
+        return self._queue(id, BatchOperation.delete_object(id))
+
+    def flush(self):
+        """Sends the queued writes and returns their results."""
+        writes, self._writes = self._writes, []
+        # Split the writes in waves holding at most one write per parent
+        waves = []
+        counts = {}
+        for index, (parent, operation) in enumerate(writes):
+            wave = counts.get(parent, 0)
+            counts[parent] = wave + 1
+            if wave == len(waves):
+                waves.append([])
+            waves[wave].append(index)
+
+        results = [None] * len(writes)
+        for wave in waves:
+            responses = self.graph.batch([writes[i][1] for i in wave],
+                                         parallel=True,
+                                         max_workers=self.max_workers)
+            for index, response in zip(wave, responses):
+                results[index] = response
+        return results
 
 
 class GraphAPIError(Exception):
@@ -523,12 +3018,16 @@ class InvalidOAuthError(OAuthError):
 
 
 def raise_error(response):
-    
-    code = response['error']['code']
+    """Returns the GraphAPIError subclass matching an error response.
+
+    Unknown error codes are mapped to GraphAPIError itself.
+
+    """
+    code = response['error'].get('code')
     error_subcode = None
 
     if code in (190, 102):
-        error_subcode = response['error']['error_subcode']
+        error_subcode = response['error'].get('error_subcode')
 
     exceptions = { 
             190: 
@@ -544,23 +3043,141 @@ def raise_error(response):
             2 : ServerError,
             4 : ServerError,
             17 : ServerError,
+            32 : ServerError,
+            613 : ServerError,
             10 : UserError
             }
 
     exceptions[102] = exceptions[190]
 
-    if error_subcode:
-        return exceptions[code][error_subcode]
+    if code in (190, 102):
+        return exceptions[code].get(error_subcode, OAuthError)
+
+    return exceptions.get(code, GraphAPIError)
 
-    return exceptions[code]
 
+class RetryBudget(object):
+    """Bounds the retries of every call sharing it.
 
+    Retries are allowed as long as they stay below min_retries plus
+    ratio times the number of calls made, so that a Facebook outage
+    cannot multiply the load of a whole crawl.
+
+    """
+    def __init__(self, ratio=0.2, min_retries=10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.calls = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def call(self):
+        with self._lock:
+            self.calls += 1
+
+    def withdraw(self):
+        """Returns True if one more retry is allowed, and counts it."""
+        with self._lock:
+            if self.retries >= self.min_retries + self.ratio * self.calls:
+                return False
+            self.retries += 1
+            return True
+
+
+# Number of the attempt RetryPolicy.run is making in the current thread
+_retry_state = threading.local()
+
+
+class RetryPolicy(object):
+    """Retries calls failing with transient errors.
+
+    retries maps an exception class to the number of times a call
+    failing with it is retried, the most specific class winning. Retries
+    wait a random delay between 0 and min(max_delay, base_delay * 2 **
+    attempt) (exponential backoff with full jitter) and stop once
+    max_elapsed seconds have been spent on the call or once the shared
+    RetryBudget is exhausted.
+
+    """
+    DEFAULT_RETRIES = {
+        ServerError: 5,
+        socket.timeout: 3,
+        socket.error: 3,
+        httplib.HTTPException: 3,
+    }
 
+    def __init__(self, retries=None, base_delay=0.5, max_delay=60.0,
+                 max_elapsed=300.0, budget=None):
+        self.retries = dict(self.DEFAULT_RETRIES)
+        self.retries.update(retries or {})
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_elapsed = max_elapsed
+        self.budget = budget if budget is not None else RetryBudget()
+        self.stats = {"calls": 0, "retries": 0, "failures": 0,
+                      "retries_per_call": {}}
+        self._lock = threading.Lock()
+
+    def max_retries(self, error):
+        for cls in type(error).__mro__:
+            if cls in self.retries:
+                return self.retries[cls]
+        return 0
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def _record(self, retries, failed):
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["retries"] += retries
+            self.stats["failures"] += failed
+            histogram = self.stats["retries_per_call"]
+            histogram[retries] = histogram.get(retries, 0) + 1
+
+    def run(self, function, *args, **kwargs):
+        """Calls function, retrying it, and returns (result, retries)."""
+        self.budget.call()
+        started = time.time()
+        attempt = 0
+        outer = getattr(_retry_state, "attempt", 0)
+        try:
+            while True:
+                # Lets the request hooks know which attempt they report
+                _retry_state.attempt = attempt
+                try:
+                    result = function(*args, **kwargs)
+                except Exception, e:
+                    delay = self.delay(attempt)
+                    if (attempt >= self.max_retries(e) or
+                            time.time() + delay - started >
+                            self.max_elapsed or
+                            not self.budget.withdraw()):
+                        self._record(attempt, 1)
+                        raise
+                    logging.debug("Retry %d of %r in %.2fs after %r" %
+                                  (attempt + 1, function, delay, e))
+                    time.sleep(delay)
+                    attempt += 1
+                else:
+                    self._record(attempt, 0)
+                    return result, attempt
+        finally:
+            _retry_state.attempt = outer
 
+    def call(self, function, *args, **kwargs):
+        """Calls function, retrying it, and returns its result."""
+        return self.run(function, *args, **kwargs)[0]
 
+    def statistics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats["retries_per_call"] = dict(stats["retries_per_call"])
+        return stats
 
 
-def get_user_from_cookie(cookies, app_id, app_secret):
+def get_user_from_cookie(cookies, app_id, app_secret, pool=None):
     """Parses the cookie set by the official Facebook JavaScript SDK.
 
     cookies should be a dictionary-like object mapping cookie names to
@@ -577,22 +3194,72 @@ def get_user_from_cookie(cookies, app_id, app_secret):
     authentication at
     http://developers.facebook.com/docs/authentication/.
 
+    pool is the ConnectionPool used to exchange the code, by default the
+    module wide default_pool.
+
+    The user found in a cookie is cached in cookie_cache, so that the
+    following requests carrying the same cookie do not exchange the code
+    again.
+
     """
     cookie = cookies.get("fbsr_" + app_id, "")
     if not cookie:
         return None
+    key = (app_id, cookie)
+    result = cookie_cache.get(key)
+    if result is not None:
+        return dict(result)
     parsed_request = parse_signed_request(cookie, app_secret)
     if not parsed_request:
         return None
     try:
         result = get_access_token_from_code(parsed_request["code"], "",
-                                            app_id, app_secret)
+                                            app_id, app_secret, pool=pool)
     except GraphAPIError:
         return None
     result["uid"] = parsed_request["user_id"]
+    cookie_cache.set(key, dict(result))
     return result
 
 
+# Users of the fbsr_ cookies already seen by get_user_from_cookie, and
+# payloads of the signed requests already verified. The code of a
+# signed request can only be exchanged for a few minutes, hence the ttl
+cookie_cache = LRUCache(max_entries=10000, sizeof=lambda value: 1, ttl=600)
+signed_request_cache = LRUCache(max_entries=10000, sizeof=lambda value: 1,
+                                ttl=600)
+
+# HMAC-SHA256 objects keyed with each app secret, copied for each request
+_hmac_keys = {}
+
+try:
+    _compare_digest = hmac.compare_digest
+except AttributeError:
+    # Python < 2.7.7
+    def _compare_digest(a, b):
+        """Compares a and b in a time independent of their content."""
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def _signature(app_secret, payload):
+    """Returns the HMAC-SHA256 of payload keyed with app_secret."""
+    # HMAC can only handle ascii (byte) strings
+    # http://bugs.python.org/issue5285
+    app_secret = app_secret.encode('ascii')
+    key = _hmac_keys.get(app_secret)
+    if key is None:
+        key = _hmac_keys[app_secret] = hmac.new(app_secret,
+                                                digestmod=hashlib.sha256)
+    signature = key.copy()
+    signature.update(payload.encode('ascii'))
+    return signature.digest()
+
+
 def parse_signed_request(signed_request, app_secret):
     """ Return dictionary with signed request data.
 
@@ -601,8 +3268,14 @@ def parse_signed_request(signed_request, app_secret):
     your application, as well as any information requested.
 
     If the signed_request is malformed or corrupted, False is returned.
+    Verified requests are cached in signed_request_cache.
 
     """
+    key = (signed_request, app_secret)
+    cached = signed_request_cache.get(key)
+    if cached is not None:
+        return dict(cached)
+
     try:
         encoded_sig, payload = map(str, signed_request.split('.', 1))
 
@@ -610,31 +3283,38 @@ def parse_signed_request(signed_request, app_secret):
                                        ((4 - len(encoded_sig) % 4) % 4))
         data = base64.urlsafe_b64decode(payload + "=" *
                                         ((4 - len(payload) % 4) % 4))
-    except IndexError:
+    except (IndexError, ValueError):
         # Signed request was malformed.
         return False
     except TypeError:
         # Signed request had a corrupted payload.
         return False
 
-    data = _parse_json(data)
-    if data.get('algorithm', '').upper() != 'HMAC-SHA256':
+    try:
+        data = _parse_json(data)
+    except ValueError:
+        return False
+    if not isinstance(data, dict) or \
+            data.get('algorithm', '').upper() != 'HMAC-SHA256':
         return False
 
-    # HMAC can only handle ascii (byte) strings
-    # http://bugs.python.org/issue5285
-    app_secret = app_secret.encode('ascii')
-    payload = payload.encode('ascii')
-
-    expected_sig = hmac.new(app_secret,
-                            msg=payload,
-                            digestmod=hashlib.sha256).digest()
-    if sig != expected_sig:
+    if not _compare_digest(sig, _signature(app_secret, payload)):
         return False
 
+    signed_request_cache.set(key, dict(data))
     return data
 
 
+def parse_signed_requests(signed_requests, app_secret):
+    """Verifies many signed requests of an app, as parse_signed_request.
+
+    Returns the list of their payloads (False for the invalid ones).
+
+    """
+    return [parse_signed_request(signed_request, app_secret)
+            for signed_request in signed_requests]
+
+
 def auth_url(app_id, canvas_url, perms=None, **kwargs):
     url = "https://www.facebook.com/dialog/oauth?"
     kvps = {'client_id': app_id, 'redirect_uri': canvas_url}
@@ -643,7 +3323,8 @@ def auth_url(app_id, canvas_url, perms=None, **kwargs):
     kvps.update(kwargs)
     return url + urllib.urlencode(kvps)
 
-def get_access_token_from_code(code, redirect_uri, app_id, app_secret):
+def get_access_token_from_code(code, redirect_uri, app_id, app_secret,
+                               pool=None):
     """Get an access token from the "code" returned from an OAuth dialog.
 
     Returns a dict containing the user-specific access token and its
@@ -658,8 +3339,9 @@ def get_access_token_from_code(code, redirect_uri, app_id, app_secret):
     }
     # We would use GraphAPI.request() here, except for that the fact
     # that the response is a key-value pair, and not JSON.
-    response = urllib.urlopen("https://graph.facebook.com/oauth/access_token" +
-                              "?" + urllib.urlencode(args)).read()
+    response = _read_response(_get_pool(pool).urlopen(
+        "GET", "https://graph.facebook.com/oauth/access_token" +
+        "?" + urllib.urlencode(args)))
     query_str = parse_qs(response)
     if "access_token" in query_str:
         result = {"access_token": query_str["access_token"][0]}
@@ -671,7 +3353,7 @@ def get_access_token_from_code(code, redirect_uri, app_id, app_secret):
         raise raise_error(response), response
 
 
-def get_app_access_token(app_id, app_secret):
+def get_app_access_token(app_id, app_secret, pool=None):
     """Get the access_token for the app.
 
     This token can be used for insights and creating test users.
@@ -687,17 +3369,15 @@ def get_app_access_token(app_id, app_secret):
             'client_id': app_id,
             'client_secret': app_secret}
 
-    file = urllib2.urlopen("https://graph.facebook.com/oauth/access_token?" +
-                           urllib.urlencode(args))
-
-    try:
-        result = file.read().split("=")[1]
-    finally:
-        file.close()
+    response = _read_response(_get_pool(pool).urlopen(
+        "GET", "https://graph.facebook.com/oauth/access_token?" +
+        urllib.urlencode(args)))
+    result = response.split("=")[1]
 
     return result
 
-def get_long_lived_access_token(app_id, app_secret, short_lived_token):
+def get_long_lived_access_token(app_id, app_secret, short_lived_token,
+                                pool=None):
     """Get the access_token for the app.
 
     This token can be used for insights and creating test users.
@@ -718,18 +3398,14 @@ def get_long_lived_access_token(app_id, app_secret, short_lived_token):
             'fb_exchange_token': short_lived_token
             }
 
-    f = urllib2.urlopen("https://graph.facebook.com/oauth/access_token?" +
-                           urllib.urlencode(args))
-
-
-    try:
-        result = f.read().split("=")[1].split("&")[0]
-    finally:
-        f.close()
+    response = _read_response(_get_pool(pool).urlopen(
+        "GET", "https://graph.facebook.com/oauth/access_token?" +
+        urllib.urlencode(args)))
+    result = response.split("=")[1].split("&")[0]
 
     return result
 
-def debug_access_token(input_token, access_token):
+def debug_access_token(input_token, access_token, pool=None):
     """Get debug information for an access_token
 
     input_token: the access token you want to get information about
@@ -762,26 +3438,210 @@ def debug_access_token(input_token, access_token):
             'access_token': access_token,
             }
 
-    response = urllib.urlopen("https://graph.facebook.com/debug_token" +
-                              "?" + urllib.urlencode(args)).read()
+    response = _read_response(_get_pool(pool).urlopen(
+        "GET", "https://graph.facebook.com/debug_token" +
+        "?" + urllib.urlencode(args)))
 
     response = json.loads(response)
     return response
 
 
-def valid_access_token(input_token, access_token):
+def valid_access_token(input_token, access_token, pool=None, tokens=None):
     """
         Return False if access token not valid
         Return (True, expiration_time in unix time, expiration time human
         readable) if still valid
+
+        If tokens, a TokenManager, is given, its cached debug_token results
+        are used instead of a request
     """
 
-    response = debug_access_token(input_token, access_token)
-    response = response['data']
+    if tokens is not None:
+        response = tokens.debug(input_token)
+    else:
+        response = debug_access_token(input_token, access_token, pool=pool)
+        response = response['data']
 
 
-    if response["is_valid"]:
-        import time
-        return True, response["expires_at"], int(time.ctime(int(response["expires_at"])))
+    if response.get("is_valid"):
+        expires_at = int(response.get("expires_at", 0))
+        return True, expires_at, time.ctime(expires_at)
     else:
         return False
+
+
+class TokenManager(object):
+    """Keeps the access token of GraphAPI clients valid.
+
+       tokens = facebook.TokenManager(app_id, app_secret, access_token,
+                                      path="token.json")
+       graph = facebook.GraphAPI(token_manager=tokens)
+
+    The expiry of the token is learnt from debug_token, whose results
+    are cached until the token expires (and for debug_ttl seconds at
+    most), and the app access token used
+    to call it is fetched once. When the token gets within
+    refresh_margin seconds of its expiry, it is extended in a background
+    thread while requests keep using the current one. Refreshes are
+    single flight: concurrent callers wait for the refresh in progress
+    instead of starting their own. A failed refresh is not tried again
+    before retry_interval seconds: the current token is used meanwhile,
+    and refresh() raises the error it failed with. If path is given,
+    the token and its expiry are saved there and loaded back on restart:
+    access_token is then only used if no token was saved or if the saved
+    one has expired.
+
+    """
+    def __init__(self, app_id, app_secret, access_token=None, path=None,
+                 refresh_margin=24 * 3600, debug_ttl=3600, pool=None,
+                 retry_interval=60):
+        self.app_id = app_id
+        self.app_secret = app_secret
+        self.path = path
+        self.refresh_margin = refresh_margin
+        self.debug_ttl = debug_ttl
+        self.pool = pool
+        self.retry_interval = retry_interval
+        self.access_token = access_token
+        # Unix time the token expires at, 0 if it never does, None if
+        # not known yet
+        self.expires_at = None
+        self.refreshes = 0
+        self._app_token = None
+        self._debug_cache = {}
+        self._lock = threading.Lock()
+        self._refreshing = None
+        # Unix time and error of the last failed refresh
+        self._failed_at = None
+        self._error = None
+        if path and os.path.exists(path):
+            self._load()
+        # The saved token is the refreshed one, newer than access_token
+        if access_token is not None and access_token != self.access_token \
+                and (not self.access_token or self._expired()):
+            self.set_token(access_token)
+
+    def _load(self):
+        with open(self.path) as f:
+            state = json.load(f)
+        self.access_token = state.get("access_token")
+        self.expires_at = state.get("expires_at")
+
+    def _save(self):
+        if not self.path:
+            return
+        state = {"access_token": self.access_token,
+                 "expires_at": self.expires_at}
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            json.dump(state, f)
+        os.rename(temporary, self.path)
+
+    def set_token(self, access_token, expires_at=None):
+        """Replaces the token, its expiry is looked up if not given."""
+        with self._lock:
+            self.access_token = access_token
+            self.expires_at = expires_at
+            self._save()
+
+    @property
+    def app_token(self):
+        """The app access token, fetched once."""
+        if self._app_token is None:
+            self._app_token = get_app_access_token(self.app_id,
+                                                   self.app_secret,
+                                                   pool=self.pool)
+        return self._app_token
+
+    def debug(self, token=None):
+        """Returns the cached debug_token data of token."""
+        token = token or self.access_token
+        now = time.time()
+        with self._lock:
+            cached = self._debug_cache.get(token)
+        if cached is not None and cached[1] > now:
+            return cached[0]
+        data = debug_access_token(token, self.app_token,
+                                  pool=self.pool).get("data", {})
+        cached_until = now + self.debug_ttl
+        if data.get("expires_at"):
+            cached_until = min(cached_until, data["expires_at"])
+        with self._lock:
+            self._debug_cache[token] = (data, cached_until)
+            if token == self.access_token and self.expires_at is None:
+                self.expires_at = data.get("expires_at", 0)
+                self._save()
+        return data
+
+    def is_valid(self, token=None):
+        return bool(self.debug(token).get("is_valid"))
+
+    def _expired(self):
+        return bool(self.expires_at) and self.expires_at <= time.time()
+
+    def _needs_refresh(self):
+        if not self.expires_at:
+            return False
+        return self.expires_at - time.time() < self.refresh_margin
+
+    def get_token(self):
+        """Returns a valid token, refreshing it ahead of its expiry."""
+        if self.access_token and self.expires_at is None:
+            try:
+                self.debug()
+            except Exception, e:
+                logging.warning("Could not debug the access token: %s" % e)
+                self.expires_at = 0
+        if self._needs_refresh():
+            if self.expires_at <= time.time():
+                # Too late to refresh in the background. If it fails the
+                # expired token is returned, the request fails with it
+                try:
+                    self.refresh()
+                except Exception:
+                    pass
+            elif self._refreshing is None:
+                thread = threading.Thread(target=self.refresh,
+                                          kwargs={"wait": False})
+                thread.daemon = True
+                thread.start()
+        return self.access_token
+
+    def refresh(self, wait=True):
+        """Extends the token, only once for concurrent callers."""
+        with self._lock:
+            if self._failed_at is not None and \
+                    time.time() - self._failed_at < self.retry_interval:
+                # Backing off after a failed refresh
+                if wait:
+                    raise self._error
+                return self.access_token
+            event = self._refreshing
+            leader = event is None
+            if leader:
+                event = self._refreshing = threading.Event()
+        if not leader:
+            if wait:
+                event.wait()
+            return self.access_token
+        try:
+            graph = GraphAPI(self.access_token, pool=self.pool,
+                             rate_limiter=False)
+            result = graph.extend_access_token(self.app_id, self.app_secret)
+            expires_at = 0
+            if result.get("expires"):
+                expires_at = int(time.time()) + int(result["expires"])
+            self.set_token(result["access_token"], expires_at)
+            self.refreshes += 1
+            self._failed_at = None
+        except Exception, e:
+            logging.warning("Could not refresh the access token: %s" % e)
+            self._failed_at = time.time()
+            self._error = e
+            if wait:
+                raise
+        finally:
+            with self._lock:
+                self._refreshing = None
+            event.set()
+        return self.access_token
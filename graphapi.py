@@ -25,18 +25,328 @@
 #   content with new posts, comments, subscriptions, and get 
     
 import facebook # Import facebook.py to use python client for facebook API
-from gluon import * # To import web2py libraries and tools
-                    # In occurence, current
 
 from urlparse import urlparse   # To get query string from url. Most used
                                 # in get_query_parameters()
-# Get database access layer from current
+import collections
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+import weakref
+import Queue
+
+# Importing this module has no side effect: the database and the
+# credentials are bound lazily by the Context below
 table_name_prefix = 'facebook'
-db = current.db
 
-app_id = '239533669516062'
-app_secret = '706a63e3fec89fbc35e0c92eac57ad66'
-access_token = 'CAADZA2sdIgx4BAEVgPkiSvtD689tGOTmhbeZBIkeXboNsxDBMSgMOCq4uZAfZBCrsQmcDrPPZB98t5jCMlzoPZBqa2lhBWwVL0kEf7FezcvbJv3eydjnZA4dR8ZAe27JLl8rFcWTw9BnJnh8AwCb8217EJkFVSbUBH0ZD'
+# Launch of Facebook, no group data is older than that (unix time)
+FACEBOOK_EPOCH = 1075852800
+
+class TypeCache(object):
+    """
+        Type of Facebook objects ('user', 'group', ...) by id, as given by
+        metadata=1. The type of an object never changes, so types are kept
+        as long as the cache, and in the sqlite database at path if given
+        so that they survive restarts
+    """
+
+    def __init__(self, path=None):
+        self._types = dict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS object_type ('
+                    'facebook_id TEXT PRIMARY KEY, type TEXT)')
+            self._db.commit()
+            self._types.update(self._db.execute(
+                    'SELECT facebook_id, type FROM object_type'))
+            pass
+        pass
+
+    def __len__(self):
+        return len(self._types)
+
+    def get(self, facebook_id):
+        return self._types.get(facebook_id)
+
+    def update(self, types):
+        """
+            types: dict {facebook_id: type}
+        """
+        with self._lock:
+            self._types.update(types)
+            if self._db is not None:
+                self._db.executemany('INSERT OR REPLACE INTO object_type '
+                        '(facebook_id, type) VALUES (?, ?)', types.items())
+                self._db.commit()
+                pass
+            pass
+        pass
+
+# Watermark of a connection, see WatermarkStore
+Watermark = collections.namedtuple('Watermark', 'time ids synced')
+
+class SyncError(Exception):
+    """
+        A connection read by Base.sync_connection stopped before its end or
+        its watermark, a page could not be fetched for instance. The
+        watermark is kept so that the next sync reads the items again
+    """
+    pass
+
+class WatermarkStore(object):
+    """
+        Watermarks of the connections already read, by (facebook_id,
+        connection): the unix time of the newest item read, the ids of the
+        newest items and the unix time of the sync. Base.sync_connection
+        reads only the items which are newer than them. Watermarks are
+        kept in the sqlite database at path if given so that they survive
+        restarts
+    """
+
+    def __init__(self, path=None):
+        self._watermarks = dict()
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS watermark ('
+                    'facebook_id TEXT, connection TEXT, time INTEGER, '
+                    'ids TEXT, synced INTEGER, '
+                    'PRIMARY KEY (facebook_id, connection))')
+            self._db.commit()
+            for facebook_id, connection, time, ids, synced in \
+                    self._db.execute('SELECT facebook_id, connection, time, '
+                            'ids, synced FROM watermark'):
+                self._watermarks[(facebook_id, connection)] = Watermark(
+                        time, tuple(ids.split(',')) if ids else (), synced)
+                pass
+            pass
+        pass
+
+    def __len__(self):
+        return len(self._watermarks)
+
+    def get(self, facebook_id, connection):
+        """
+            Returns the Watermark of the connection, None if it has never
+            been read
+        """
+        return self._watermarks.get((facebook_id, connection))
+
+    def set(self, facebook_id, connection, watermark):
+        with self._lock:
+            self._watermarks[(facebook_id, connection)] = watermark
+            if self._db is not None:
+                self._db.execute('INSERT OR REPLACE INTO watermark '
+                        '(facebook_id, connection, time, ids, synced) '
+                        'VALUES (?, ?, ?, ?, ?)', (facebook_id, connection,
+                            watermark.time, ','.join(watermark.ids),
+                            watermark.synced))
+                self._db.commit()
+                pass
+            pass
+        pass
+
+    def delete(self, facebook_id, connection):
+        with self._lock:
+            self._watermarks.pop((facebook_id, connection), None)
+            if self._db is not None:
+                self._db.execute('DELETE FROM watermark WHERE facebook_id = ? '
+                        'AND connection = ?', (facebook_id, connection))
+                self._db.commit()
+                pass
+            pass
+        pass
+
+def object_size(instance):
+    """
+        Estimate of the memory used by a Base object, in bytes: the object,
+        its attributes, its fields and its Facebook object. Referenced Base
+        objects are left out, they are counted on their own
+    """
+    size = sys.getsizeof(instance)
+    for value in vars(instance).itervalues():
+        size += sys.getsizeof(value)
+        pass
+    for data in (instance, getattr(instance, 'facebook_object', None) or {}):
+        for key, value in data.iteritems():
+            size += sys.getsizeof(key)
+            if not isinstance(value, Base):
+                size += sys.getsizeof(value)
+                pass
+            pass
+        pass
+    return size
+
+class IdentityMap(object):
+    """
+        Base objects of a crawl session by (type, facebook_id), so that an
+        object met many times (a user who is a member, the author of posts
+        and comments, ...) is fetched and built only once.
+
+        The most recently used objects are kept, up to max_entries objects
+        and max_bytes bytes as estimated by object_size. If weak is True,
+        evicted objects can still be found as long as they are referenced
+        elsewhere, by the post they are the author of for instance.
+
+        The map only lasts for a crawl session, it is cleared by
+        Context.new_session
+    """
+
+    def __init__(self, max_entries=10000, max_bytes=64 * 1024 * 1024,
+            weak=False):
+        self._objects = facebook.LRUCache(max_entries=max_entries,
+                max_bytes=max_bytes, sizeof=object_size)
+        self._weak = weakref.WeakValueDictionary() if weak else None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        pass
+
+    def __len__(self):
+        return len(self._objects)
+
+    def get(self, key):
+        """
+            key: (type, facebook_id). Returns the object or None
+        """
+        instance = self._objects.get(key)
+        if instance is None and self._weak is not None:
+            instance = self._weak.get(key)
+            if instance is not None:
+                self._objects.set(key, instance)
+                pass
+            pass
+        with self._lock:
+            if instance is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return instance
+
+    def set(self, key, instance):
+        self._objects.set(key, instance)
+        if self._weak is not None:
+            self._weak[key] = instance
+            pass
+        pass
+
+    def clear(self):
+        self._objects.clear()
+        if self._weak is not None:
+            self._weak.clear()
+            pass
+        pass
+
+    def statistics(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                    'entries': len(self._objects),
+                    'bytes': self._objects.size,
+                    'evictions': self._objects.evictions,
+                    }
+
+class Context(object):
+    """
+        Database access layer and Facebook credentials used by the module.
+
+        db_factory is called to connect to the database the first time it
+        is used in a process, and again in every process forked from it, so
+        that forked workers never share a connection. An already connected
+        db can be given instead, it is then used as is. Without either, the
+        db of the running web2py request (gluon.current.db) is used.
+
+        Credentials which are not given are read from the FACEBOOK_APP_ID,
+        FACEBOOK_APP_SECRET and FACEBOOK_ACCESS_TOKEN environment variables
+
+        The context also holds the type of the objects already met
+        (self.types, a TypeCache saved in types_path if given), the
+        watermarks of the connections already read (self.watermarks, a
+        WatermarkStore saved in watermarks_path if given), the Facebook
+        objects fetched in advance by Base.prefetch
+        (self.prefetched, an LRU of at most max_prefetched objects kept
+        prefetched_ttl seconds at most) and the objects built by
+        Base.factory (self.identity_map, an IdentityMap). The last two only
+        last for a session, see Context.new_session
+    """
+
+    def __init__(self, db=None, db_factory=None, app_id=None,
+            app_secret=None, access_token=None, types_path=None,
+            max_prefetched=10000, identity_map=None, watermarks_path=None,
+            prefetched_ttl=600):
+        self._db = db
+        self._db_pid = os.getpid() if db is not None else None
+        self.db_factory = db_factory
+        self.app_id = app_id or os.environ.get('FACEBOOK_APP_ID')
+        self.app_secret = app_secret or os.environ.get('FACEBOOK_APP_SECRET')
+        self.access_token = access_token or \
+                os.environ.get('FACEBOOK_ACCESS_TOKEN')
+        self.types = TypeCache(types_path)
+        self.watermarks = WatermarkStore(watermarks_path)
+        self.prefetched = facebook.LRUCache(max_entries=max_prefetched,
+                sizeof=lambda facebook_object: 1, ttl=prefetched_ttl)
+        self.identity_map = identity_map if identity_map is not None \
+                else IdentityMap()
+        pass
+
+    @property
+    def db(self):
+        if self.db_factory is not None:
+            # Connect once per process
+            if self._db is None or self._db_pid != os.getpid():
+                self._db = self.db_factory()
+                self._db_pid = os.getpid()
+                pass
+            return self._db
+        if self._db is not None:
+            return self._db
+
+        # web2py is only imported when its database is needed
+        from gluon import current
+        return current.db
+
+    def new_session(self):
+        """
+            Start a new crawl session, set_members, set_feed and
+            crawler.Crawler.run each being one. The objects fetched in
+            advance during the previous sessions are forgotten, so that
+            they are fetched again instead of being stored stale, and so are
+            the objects built by Base.factory
+        """
+        self.prefetched.clear()
+        self.identity_map.clear()
+        pass
+
+    def graph(self, **kwargs):
+        """
+            Returns a facebook.GraphAPI client using the context token
+        """
+        return facebook.GraphAPI(self.access_token, **kwargs)
+
+# Context of the module, replaced by configure()
+context = Context()
+
+def configure(*args, **kwargs):
+    """
+        Set the Context used by the module, see Context for the arguments.
+        Workers forked afterwards connect to the database on their own if
+        a db_factory is given:
+
+            graphapi.configure(db_factory=lambda: DAL(uri, migrate=False))
+    """
+    global context
+    context = Context(*args, **kwargs)
+    return context
+
 facebook_profile_id = '100003123256932'
 facebook_id = '335662792434' # Facebook Group ID
 facebook_post_id = '335662792434_10150431047037435'
@@ -67,16 +377,66 @@ def get_query_parameters(url):
     
 
 class Base(dict):
+    # Facebook fields of the objects {field: supported}, extended by each
+    # subclass with its own. They are the same for every instance, so they
+    # are known before a class is instantiated, see Base.fields_projection
+    facebook_fields = {
+            'id':True,      # The object ID, string
+            'name':True,    # The name of the object, string
+            }
+
+    # fields= projection of each subclass, built once per class by
+    # Base.fields_projection
+    _fields_projections = dict()
+
+    # Retry policy of Base.get. It is shared by every object so that its
+    # retry budget bounds the retries of a whole crawl. Assign a
+    # facebook.RetryPolicy to Base.retry_policy to configure it
+    retry_policy = facebook.RetryPolicy()
+
+    # Fields holding the URL of a picture, or a dict with its URL in
+    # 'source' like a cover. They are downloaded by Base.archive_media
+    media_fields = ()
+
+    # Maximum number of ids of an ids= request
+    ids_per_request = 50
+
+    # Number of objects set_members and set_feed fetch in advance, see
+    # Base.prefetch
+    prefetch_size = 500
+
+    # Number of the newest items of a connection kept in its watermark,
+    # see Base.sync_connection
+    watermark_items = 25
+
     @staticmethod
-    def factory(object_type, facebook_id, graph, *args, **kwargs):
+    def object_class(object_type):
+        """
+            Class instantiated by Base.factory for object_type, None if the
+            type is not supported
+        """
         object_types = {
                 'group' : FcbGroup,
                 'user' : FcbUser,
                 }
 
-        assert object_type in object_types, "Unknown object type"
+        return object_types.get(object_type)
+
+    @staticmethod
+    def factory(object_type, facebook_id, graph, *args, **kwargs):
+        object_class = Base.object_class(object_type)
 
-        return object_types[object_type](facebook_id, graph=graph, *args, **kwargs)
+        assert object_class is not None, "Unknown object type"
+
+        # Objects are built once per session, see IdentityMap
+        key = (object_type, facebook_id)
+        instance = context.identity_map.get(key)
+        if instance is None:
+            instance = object_class(facebook_id, graph=graph, *args, **kwargs)
+            context.identity_map.set(key, instance)
+            pass
+
+        return instance
 
     def __init__(self, facebook_id, *args, **kwargs):
         """
@@ -97,10 +457,7 @@ class Base(dict):
 
         assert isinstance(self.graph, facebook.GraphAPI), "graph parameter should be instance of GraphAPI"
 
-        self.fields = {
-                'id':True,      # The object ID, string
-                'name':True,    # The name of the object, string
-                }
+        self.fields = dict(Base.facebook_fields)
 
         self.references = {     # True if attribute.type = list:reference
                                 # False if attribute.type = reference
@@ -171,7 +528,7 @@ class Base(dict):
                         pass
 
         # Retrieve the table from the database
-        self.table = getattr(db, self.table_name)
+        self.table = getattr(context.db, self.table_name)
 
         # Call the parent child and use it to initialize the object with
         # remaining (key, value) pairs in kwargs.
@@ -223,7 +580,7 @@ class Base(dict):
 
     def exists(self, *args, **kwargs):
         assert hasattr(self, 'facebook_id'), "Missing Object ID"
-        rows = db(self.table.facebook_id == self.facebook_id)
+        rows = context.db(self.table.facebook_id == self.facebook_id)
         if rows.count():
             return True
         else:
@@ -234,44 +591,114 @@ class Base(dict):
         assert isinstance(function, type(self.get)), "Expecting a function\
                 as first argument"
 
+        # Transient errors (throttling, server errors, timeouts) are
+        # retried by self.retry_policy. self.retries is the number of
+        # retries of the last call
         response = None
-        try:
-            response = function(*args, **kwargs)
-        except (facebook.AppOAuthError, facebook.PasswordOAuthError,
-                facebook.ExpiredOAuthError, facebook.InvalidOAuthError), e:
-            # Extend access Token life. 
-            # This method returs {'access_token': TOKEN, 'expires': EXPIRES}
-            result = self.graph.extend_access_token(app_id, app_secret)
-            self.graph.access_token = result['access_token']
-
-            # Once token life is extended replay
-            response = function(*args, **kwargs)
-        except facebook.ServerError, e:
-            # The server is throttling, retry later
-            pass
-        except facebook.UserError, e:
-            # API Permission Denied or API Permission
-            # The user has to grant the application
-            # Inform the administrator by sending him a mail. Then we need
-            # here the mail information of the administrator.
-            pass
-        except facebook.UserOAuthError, e:
-            # User needs to log on www.facebook.com or m.facebook.com
-            pass
-        except facebook.AppOAuthError, e:
-            # User removed the app from its settings
-            pass
-        except facebook.UnconfirmedOAuthError, e:
-            # User needs to log on www.facebook.com or m.facebook.com
-            pass
-        except Exception, e:
-            print e
-            pass
+        self.retries = 0
+        refresh = False
+        while True:
+            try:
+                if refresh:
+                    # Extend access Token life. 
+                    # This method returs {'access_token': TOKEN, 'expires': EXPIRES}
+                    # A token manager refreshes the token only once for all the
+                    # objects hitting the error at the same time
+                    if self.graph.token_manager is not None:
+                        self.graph.token_manager.refresh()
+                    else:
+                        result = self.graph.extend_access_token(context.app_id,
+                                context.app_secret)
+                        self.graph.access_token = result['access_token']
+                        pass
+                    pass
+                response, self.retries = self.retry_policy.run(function,
+                        *args, **kwargs)
+            except (facebook.AppOAuthError, facebook.PasswordOAuthError,
+                    facebook.ExpiredOAuthError, facebook.InvalidOAuthError), e:
+                if not refresh:
+                    # Once token life is extended replay, the errors of the
+                    # replay are handled here as well
+                    refresh = True
+                    continue
+                logging.warning("Request failed after refreshing the access "
+                        "token: %s" % e)
+            except facebook.ServerError, e:
+                # The server kept throttling or failing after all the retries
+                # the policy allowed
+                logging.warning("Request failed after its retries: %s" % e)
+            except facebook.UserError, e:
+                # API Permission Denied or API Permission
+                # The user has to grant the application
+                # Inform the administrator by sending him a mail. Then we need
+                # here the mail information of the administrator.
+                pass
+            except facebook.UserOAuthError, e:
+                # User needs to log on www.facebook.com or m.facebook.com
+                pass
+            except facebook.AppOAuthError, e:
+                # User removed the app from its settings
+                pass
+            except facebook.UnconfirmedOAuthError, e:
+                # User needs to log on www.facebook.com or m.facebook.com
+                pass
+            except Exception, e:
+                logging.warning("Request failed: %s" % e)
+                pass
+            break
 
         return response
 
 
+    @classmethod
+    def fields_projection(cls):
+        """
+            Comma separated list of the Facebook fields stored by this
+            class. It is used as the fields= argument of Graph API requests
+            so that Facebook only sends what self.filter_object would keep.
+
+            Fields are the same for every instance of a class: the
+            projection is built from the facebook_fields of the class and
+            its parents, without instantiating it, once per class and
+            cached in Base._fields_projections
+        """
+        if cls not in Base._fields_projections:
+            # Fields of the subclasses are added to the ones of their
+            # parents, as in their __init__
+            merged = dict()
+            for klass in reversed(cls.__mro__):
+                merged.update(vars(klass).get('facebook_fields', dict()))
+                pass
+            # Facebook fields mapped to a table column (self.table_fields)
+            # are still requested with their Facebook name
+            fields = set(field for field, supported in merged.iteritems()
+                    if supported)
+            fields.add('id')
+            Base._fields_projections[cls] = ','.join(sorted(fields))
+            pass
+
+        return Base._fields_projections[cls]
+
     def get_object(self, *args, **kwargs):
+        # Use the objects fetched in advance by Base.prefetch. They are
+        # copied since self.update modifies self.facebook_object
+        if not args and not kwargs:
+            facebook_object = context.prefetched.get(self.facebook_id)
+            if facebook_object is not None:
+                self.facebook_object = dict(facebook_object)
+                return self.facebook_object
+            pass
+
+        # Only request supported fields unless the caller asks otherwise.
+        # metadata=True adds the object type to the response
+        kwargs.setdefault('fields', self.fields_projection())
+        # The table name tells the response cache which time to live
+        # applies to this type of object
+        kwargs.setdefault('cache_kind', self.__table_name)
+        if kwargs.pop('metadata', False):
+            kwargs['metadata'] = 1
+            pass
+
         self.facebook_object = self.get(self.graph.get_object, 
                 self.facebook_id, *args, **kwargs)
 
@@ -280,17 +707,38 @@ class Base(dict):
     def get_connection(self, connection, **kwargs):
         assert connection in self.connections, "Connection not supported"
 
-        # Obtain data from Facebook
+        # Obtain data from Facebook page by page
         # Use built-in get method because it takes care of all exception
-        # handling
-        response = self.get(self.graph.get_connections,\
-                self.facebook_id, 
-                connection, 
-                as_generator=True,
-                fields='id', 
-                **kwargs)
+        # handling. Each page is fetched through it so that a transient
+        # error is retried for that page instead of ending the connection.
+        # The paginator fetches the next pages while this one is processed.
+        # It stops when self.get gives up on a page.
+        # Paginator options (max_items, since, after, ...) can be given in
+        # kwargs, the others are sent to Facebook
+        options = dict((name, kwargs.pop(name)) for name in ('prefetch',
+                'max_pages', 'max_items', 'deadline', 'time_field', 'after',
+                'seen')
+                if name in kwargs)
+        if 'since' in kwargs:
+            options['since'] = kwargs['since']
+            if options.get('time_field', 'created_time') != 'created_time':
+                # Facebook filters since= on the creation time, it would
+                # leave out the older items updated since
+                del kwargs['since']
+                pass
+            pass
+        options.setdefault('prefetch', self.graph.prefetch)
+        options.setdefault('max_pages', self.graph.max_pages)
+        kwargs.setdefault('fields', 'id')
+
+        def fetch(url):
+            return self.get(self.graph.get_page, url, cache_kind=connection)
+
+        self.paginator = paginator = facebook.Paginator(self.graph,
+                self.facebook_id + '/' + connection, kwargs,
+                cache_kind=connection, fetch=fetch, **options)
         result = []
-        for page, url in response:
+        for page, url in paginator:
             for item in page:
                 result.append(item)
                 pass
@@ -298,6 +746,205 @@ class Base(dict):
 
         return result
 
+    def sync_connection(self, connection, full=False, time_field=None,
+            **kwargs):
+        """
+            Get the items of connection which are newer than its watermark
+            (see WatermarkStore), a connection sorted from the newest item
+            like a feed or the members of a group.
+
+            If time_field is given, paging stops at the first item older
+            than the newest item read (since=) and the items already read
+            are skipped unless they were updated since. Otherwise it stops
+            at the first item already read. A connection which has never been
+            read, or which is read with full=True to reconcile it with
+            Facebook, is read from its first page to its last one.
+
+            The new watermark is pending until Base.commit_watermark is
+            called, once the items are stored, so that items are read again
+            if storing them fails. SyncError is raised if the connection
+            could not be read up to its end or its watermark: the items
+            read are only part of the new ones, a watermark set from them
+            would skip the others
+        """
+        watermark = None
+        if not full:
+            watermark = context.watermarks.get(self.facebook_id, connection)
+            pass
+        if watermark is not None:
+            if time_field and watermark.time is not None:
+                kwargs['since'] = watermark.time
+                kwargs['time_field'] = time_field
+                pass
+            kwargs['seen'] = watermark.ids
+            pass
+
+        result = self.get_connection(connection, **kwargs)
+        if not self.paginator.complete:
+            raise SyncError('%s/%s was read up to item %d only' % (
+                    self.facebook_id, connection, len(result)))
+        self.pending_watermark(connection, result, time_field, watermark)
+        return result
+
+    def pending_watermark(self, connection, items, time_field=None,
+            watermark=None):
+        """
+            Set the watermark of connection, committed by
+            Base.commit_watermark, from items (newest first) read after
+            watermark
+        """
+        times = [facebook._timestamp(item[time_field]) for item in items
+                if time_field and item.get(time_field)]
+        ids = tuple(item['id'] for item in items[:self.watermark_items])
+        if watermark is not None:
+            if watermark.time is not None:
+                times.append(watermark.time)
+                pass
+            ids = (ids + tuple(watermark.ids))[:self.watermark_items]
+            pass
+
+        if not hasattr(self, 'pending_watermarks'):
+            self.pending_watermarks = dict()
+            pass
+        self.pending_watermarks[connection] = Watermark(
+                max(times) if times else None, ids, int(time.time()))
+        pass
+
+    def commit_watermark(self, connection):
+        """
+            Save the watermark of connection set by Base.sync_connection,
+            the next sync only reads the items which are newer
+        """
+        watermark = getattr(self, 'pending_watermarks', dict()).pop(
+                connection, None)
+        if watermark is not None:
+            context.watermarks.set(self.facebook_id, connection, watermark)
+            pass
+        pass
+
+    def get_objects(self, ids, **kwargs):
+        """
+            Get the Facebook objects with the given ids in ids= requests of
+            at most self.ids_per_request ids. Returns {facebook_id: object},
+            ids whose request failed are missing
+        """
+        ids = list(ids)
+        facebook_objects = dict()
+        for start in range(0, len(ids), self.ids_per_request):
+            response = self.get(self.graph.get_objects,
+                    ids[start:start + self.ids_per_request], **kwargs)
+            if response:
+                facebook_objects.update(response)
+                pass
+            pass
+
+        return facebook_objects
+
+    @property
+    def reference_fields(self):
+        """
+            List of (facebook_field, is_list) of the supported fields
+            referencing other objects. self.references is keyed by table
+            column, the Facebook field is the one mapped to that column in
+            self.table_fields, if any
+        """
+        columns = dict((column, field)
+                for field, column in self.table_fields.iteritems())
+        fields = [(columns.get(reference, reference), is_list)
+                for reference, is_list in self.references.iteritems()]
+        return [(field, is_list) for field, is_list in fields
+                if self.fields.get(field)]
+
+    @staticmethod
+    def referenced(value, is_list):
+        """
+            Referenced objects ({'id': ...}) found in a field value. Lists
+            may be sent by Facebook as {'data': [...]}
+        """
+        if is_list:
+            if isinstance(value, dict):
+                value = value.get('data', [])
+                pass
+            return [item for item in value
+                    if isinstance(item, dict) and 'id' in item]
+        if isinstance(value, dict) and 'id' in value:
+            return [value]
+        return []
+
+    def resolve_references(self, facebook_objects):
+        """
+            Fetch the objects referenced by facebook_objects (Facebook
+            objects of this class) so that Base.update instantiates them
+            without any request.
+
+            Unknown types are requested first, with metadata=1, and kept in
+            context.types so that the type of an id is only requested once.
+            The referenced objects are then requested type by type with the
+            fields of their class and kept in context.prefetched. Both are
+            done in ids= requests instead of two requests per reference
+        """
+        ids = set()
+        for facebook_object in facebook_objects:
+            if not facebook_object:
+                continue
+            for field, is_list in self.reference_fields:
+                for item in self.referenced(facebook_object.get(field),
+                        is_list):
+                    ids.add(item['id'])
+                    pass
+                pass
+            pass
+
+        unknown = [facebook_id for facebook_id in ids
+                if context.types.get(facebook_id) is None]
+        if unknown:
+            response = self.get_objects(unknown, fields='id', metadata=1)
+            context.types.update(dict((facebook_id, item['metadata']['type'])
+                    for facebook_id, item in response.iteritems()
+                    if 'metadata' in item))
+            pass
+
+        ids_by_type = dict()
+        for facebook_id in ids:
+            object_type = context.types.get(facebook_id)
+            if Base.object_class(object_type) is not None \
+                    and facebook_id not in context.prefetched:
+                ids_by_type.setdefault(object_type, []).append(facebook_id)
+                pass
+            pass
+
+        for object_type, type_ids in ids_by_type.iteritems():
+            # Only the fields stored by the class are requested
+            projection = Base.object_class(object_type).fields_projection()
+            for facebook_id, facebook_object in self.get_objects(type_ids,
+                    fields=projection, cache_kind=object_type).iteritems():
+                context.prefetched.set(facebook_id, facebook_object)
+                pass
+            pass
+        pass
+
+    def prefetch(self, ids):
+        """
+            Fetch the objects of this class with the given ids, and the
+            objects they reference, in ids= requests. Objects of this class
+            instantiated afterwards with one of these ids take their data
+            from context.prefetched instead of requesting it.
+
+            For instance, a page of 500 posts is fetched with about 10
+            requests for the posts, 10 for the types of their authors and
+            10 for the authors instead of 1500 requests
+        """
+        ids = [facebook_id for facebook_id in ids
+                if facebook_id not in context.prefetched]
+        facebook_objects = self.get_objects(ids,
+                fields=self.fields_projection(),
+                cache_kind=self.__table_name)
+        for facebook_id, facebook_object in facebook_objects.iteritems():
+            context.prefetched.set(facebook_id, facebook_object)
+            pass
+        self.resolve_references(facebook_objects.values())
+        pass
+
     def filter_object(self, facebook_object):
         """
             filter_object will remove from fields all fields not supported
@@ -311,7 +958,7 @@ class Base(dict):
         # metadata information can be requested to identify the type of
         # object to instantiate
         metadata = None
-        if 'metatadata' in facebook_object:
+        if 'metadata' in facebook_object:
             metadata = facebook_object['metadata']
 
         # Get only fields supported by the framework by removing not
@@ -360,47 +1007,55 @@ class Base(dict):
                     import sys
                     sys.exit()
 
-                # Get facebook object with metadata
-                facebook_object = \
-                        self.graph.get_object(facebook_id,
-                                metadata=1)
-                
-                # Get object type
-                object_type = facebook_object['metadata']['type']
-                
-                # Remove metadata information
-                del facebook_object['metadata']
-
-                # Instanciate the object
-                Object = Base.factory(object_type,
+                # Get facebook object type, resolved by
+                # self.resolve_references unless its request failed
+                object_type = context.types.get(facebook_id)
+                if object_type is None:
+                    # Through self.get, so that its retry policy applies.
+                    # An object whose type is still unknown is kept as sent
+                    facebook_object = self.get(self.graph.get_object,
+                            facebook_id, fields='id', metadata=1)
+                    if not facebook_object or \
+                            'metadata' not in facebook_object:
+                        return Object
+                    object_type = facebook_object['metadata']['type']
+                    context.types.update({facebook_id: object_type})
+                    pass
+
+                # Objects of types which are not supported are kept as
+                # sent by Facebook
+                if Base.object_class(object_type) is None:
+                    return Object
+
+                # Instanciate the object. It takes its data from
+                # context.prefetched if it has been fetched in advance
+                return Base.factory(object_type,
                         facebook_id,
                         graph=self.graph)
-                Object.update(facebook_object)
-                
-                return Object
 
             # Update the dictionary with key and values in arg
-            references = self.references
-            for reference in references:        # For each referenced field
-                if reference in arg:            # if referenced field data
+            for field, is_list in self.reference_fields:
+                if field in arg:                # if referenced field data
                                                 # is in arg
-                    if references[reference]:   # references[reference]:True
-                                                # if the attribute type
-                                                # defined in database
-                                                # models is list:reference else
-                                                # False
-                        for i, Object in enumerate(arg[reference]):
-                            arg[reference][i] = update_object(Object)
-                            pass
+                    if is_list:                 # True if the attribute
+                                                # type defined in database
+                                                # models is list:reference
+                                                # else False
+                        arg[field] = [update_object(Object) for Object in
+                                self.referenced(arg[field], True)]
                         pass
-                    else:                       # references[reference]:False
-                        arg[reference] = update_object(arg[reference])
+                    else:
+                        arg[field] = update_object(arg[field])
                         pass
                     pass
                 pass
 
             return arg
 
+        # Fetch every object referenced by the data at once
+        self.resolve_references([self.facebook_object] + list(args) +
+                [kwargs])
+
         # Update the dictionnary with self.facebook_object data
         facebook_object_filtered = self.filter_object(self.facebook_object)
         facebook_object_updated = update_arg(facebook_object_filtered)
@@ -458,13 +1113,181 @@ class Base(dict):
 
             # Retrieve the record ID in our database
             self.record_id = record_id = \
-                    db(self.table.facebook_id ==
+                    context.db(self.table.facebook_id ==
                             self.facebook_id).select().first()['id']
             return record_id
         else:
             self.record_id = record_id = self.table.insert(**kwargs)
             return record_id
 
+    def row(self, **kwargs):
+        """
+            Row of self.table_columns stored by Base.bulk_upsert, updated
+            with kwargs. Referenced objects are replaced by their record
+            id, None if they are not stored yet
+        """
+        def record_id(value):
+            if isinstance(value, Base):
+                return getattr(value, 'record_id', None)
+            if isinstance(value, list):
+                return [record_id(item) for item in value]
+            return value
+
+        data = dict((column, record_id(self[column]))
+                for column in self.table_columns)
+        data.update(kwargs)
+        return data
+
+    @staticmethod
+    def bulk_upsert(objects, chunk_size=500, commit=True, **kwargs):
+        """
+            Store objects, Base instances updated with their Facebook data,
+            in their tables with a few queries per chunk of chunk_size
+            objects instead of three or four queries per object as
+            Base.db_update does:
+
+                - one select of the rows already stored, by facebook_id
+                - one update per row whose columns changed
+                - one bulk_insert of the new rows
+                - one commit, unless commit is False: the caller then
+                  commits or rolls back the changes itself
+
+            kwargs are stored in every row, like facebook_group for posts.
+            Objects referenced by the objects which are not stored yet are
+            stored first so that their record id is known.
+
+            Sets the record_id of every object and returns a dictionnary
+            {facebook_id: record_id}
+        """
+        record_ids = dict()
+
+        # Objects are stored table by table, each table in chunks
+        tables = dict()
+        for instance in objects:
+            tables.setdefault(instance.table_name, []).append(instance)
+            pass
+
+        for table_name, instances in tables.iteritems():
+            for start in xrange(0, len(instances), chunk_size):
+                record_ids.update(Base._bulk_upsert_chunk(
+                        instances[start:start + chunk_size], kwargs, commit))
+                pass
+            pass
+
+        return record_ids
+
+    @staticmethod
+    def _bulk_upsert_chunk(instances, kwargs, commit=True):
+        """
+            Store instances, objects of the same table, in one transaction
+            which is committed if commit is True
+        """
+        db = context.db
+        table = instances[0].table
+
+        # Referenced objects first
+        referenced = dict()
+        for instance in instances:
+            for value in instance.values():
+                values = value if isinstance(value, list) else [value]
+                for item in values:
+                    if isinstance(item, Base) and \
+                            getattr(item, 'record_id', None) is None:
+                        referenced[(item.table_name, item.facebook_id)] = item
+                        pass
+                    pass
+                pass
+            pass
+        if referenced:
+            Base.bulk_upsert(referenced.values(), commit=commit)
+            pass
+
+        # The last instance of a facebook_id wins
+        by_id = dict()
+        for instance in instances:
+            by_id[instance.facebook_id] = instance
+            pass
+
+        columns = [column for column in table.fields if column != 'id']
+        rows = dict()
+        for facebook_id, instance in by_id.iteritems():
+            data = instance.row(**kwargs)
+            rows[facebook_id] = dict((column, data[column])
+                    for column in columns if column in data)
+            rows[facebook_id]['facebook_id'] = facebook_id
+            pass
+
+        try:
+            # Diff the rows against the stored ones in one query
+            records = db(table.facebook_id.belongs(rows.keys())).select()
+            record_ids = dict()
+            for record in records:
+                data = rows.pop(record.facebook_id, None)
+                if data is None:
+                    continue
+                record_ids[record.facebook_id] = record.id
+                changes = dict((column, value)
+                        for column, value in data.iteritems()
+                        if record[column] != value)
+                if changes:
+                    db(table.id == record.id).update(**changes)
+                    pass
+                pass
+
+            # Insert the new rows at once
+            if rows:
+                facebook_ids = rows.keys()
+                new_ids = table.bulk_insert([rows[facebook_id]
+                    for facebook_id in facebook_ids])
+                record_ids.update(zip(facebook_ids, new_ids))
+                pass
+            if commit:
+                db.commit()
+                pass
+        except:
+            db.rollback()
+            raise
+
+        for instance in instances:
+            instance.record_id = record_ids[instance.facebook_id]
+            pass
+
+        return record_ids
+
+    def archive_media(self, fetcher):
+        """
+            Download the pictures of self.media_fields with fetcher, a
+            facebook.MediaFetcher, to its content addressed store. Pictures
+            are streamed to disk and the ones already stored, by this
+            object or any other, are not downloaded again.
+
+            self.media maps each field to the sha256 digest of the picture,
+            stored in fetcher.store.path(digest). Failed downloads are
+            logged and left out of it
+        """
+        urls = dict()
+        for field in self.media_fields:
+            url = self[field]
+            if isinstance(url, dict):
+                url = url.get('source')
+                pass
+            if url:
+                urls[field] = url
+                pass
+            pass
+
+        entries = fetcher.fetch_all(urls.values())
+        self.media = dict()
+        for field, url in urls.iteritems():
+            if isinstance(entries[url], Exception):
+                logging.warning("Could not download the %s of %s: %s" %
+                        (field, self.facebook_id, entries[url]))
+                continue
+            self.media[field] = entries[url].digest
+            pass
+
+        return self.media
+
     def db_truncate(self, *args, **kwargs):
         self.table.truncate()
         pass
@@ -472,17 +1295,19 @@ class Base(dict):
     pass
 
 class FcbUser(Base):
+    # Fields of a Facebook User
+    facebook_fields = {
+            'first_name':True,        # The URL for the group's icon, string
+            'last_name':True,       # Array containing a valid URL, cover_id and image offset. Just the url is kept
+            'gender':True,       # The profile that created this group, string
+            'username':True, # A brief description of the group, string
+            'link': True,       # The URL for the group's website, string
+            'locale':True,     # The privacy setting of the group
+            'updated_time':True,# The last time the group was updated
+            }
+
     def __init__(self, facebook_id, graph, facebook_table='user'):
-        # Update the list of fields for Facebook User
-        fields = {
-                'first_name':True,        # The URL for the group's icon, string
-                'last_name':True,       # Array containing a valid URL, cover_id and image offset. Just the url is kept
-                'gender':True,       # The profile that created this group, string
-                'username':True, # A brief description of the group, string
-                'link': True,       # The URL for the group's website, string
-                'locale':True,     # The privacy setting of the group
-                'updated_time':True,# The last time the group was updated
-                }
+        fields = dict(FcbUser.facebook_fields)
 
         # Update the list of connexions supported by the app
 
@@ -499,6 +1324,19 @@ class FcbComment(Base):
             reference to object
             list of custom coumns
     """
+    # Fields of a Facebook Comment
+    facebook_fields = {
+            'from':True,        
+            'to':False,
+            'message':True,       
+            'message_tags':False, 
+            'actions':False,
+            'application':False,
+            'created_time':True,
+            'updated_time':True,
+            'like_count':False,
+            'comment_count':True,
+            }
 
     def __init__(self, facebook_id, graph, facebook_table, **kwargs):
         # Avoid direct instantiation
@@ -524,19 +1362,8 @@ class FcbComment(Base):
             references.update(kwargs['connections'])
             pass
 
-        # Update the list of fields for Facebook Group
-        fields.update({
-            'from':True,        
-            'to':False,
-            'message':True,       
-            'message_tags':False, 
-            'actions':False,
-            'application':False,
-            'created_time':True,
-            'updated_time':True,
-            'like_count':False,
-            'comment_count':True,
-            })
+        # Fields of the class override the ones of the subclasses
+        fields.update(FcbComment.facebook_fields)
 
         # Update the list of table_fields
 
@@ -579,44 +1406,6 @@ class FcbComment(Base):
         pass
 
 
-class FcbGroupComment(FcbPost):
-    """
-        Post sent to a group page
-    """
-
-    def __init__(self, facebook_id, graph, facebook_table='group_comment'):
-        # Update the list of references
-        # references are not updated because this attribute defines which
-        # facebook fields refer to an object to be created.
-        # 
-        #references = {
-        #        'facebook_group': False,    # This references a facebook
-        #                                    # group to which this post is
-        #                                    # tied to. False means that
-        #                                    # this attribute is not a list
-        #                                    # of references
-        #        }
-        super(FcbGroupPost, self).__init__(facebook_id, graph,
-                facebook_table=facebook_table, )
-
-        self.table_columns = [
-                'facebook_group_post',
-                ]
-
-    def db_update(self, facebook_group):
-        # A post has a reference to either a group or an event, in the
-        # framework of this work. In other words, a post is an item of the
-        # feed which is a list of posts. In our framework only events and
-        # groups have a feed. So we have to mention which object we are
-        # refering to. The subclass, when instantiated, will define the
-        # parent object and its ID which will be used here
-
-        record_id = super(FcbGroupPost,
-                self).db_update(facebook_group_post=facebook_group_post)
-        return record_id
-
-  
-
 class FcbPost(Base):
     """
         Child class should extend providing:
@@ -626,32 +1415,10 @@ class FcbPost(Base):
 
     
     """
-    def __init__(self, facebook_id, graph, facebook_table, **kwargs):
-        # Avoid direct instantiation
-        if type(self) == FcbPost:
-            raise TypeError, "FcbPost must be sublcassed"
-
-        fields = dict()
-        table_fields = dict()
-        references = dict()
-        connections = dict()
-
-        # Update attributes from subclasses
-        if 'fields' in kwargs:
-            fields.update(kwargs['fields'])
-            pass
-        if 'table_fields' in kwargs:
-            table_fields.update(kwargs['table_fields'])
-            pass
-        if 'references' in kwargs:
-            references.update(kwargs['references'])
-            pass
-        if 'connections' in kwargs:
-            references.update(kwargs['connections'])
-            pass
+    media_fields = ('picture',)
 
-        # Update the list of fields for Facebook Group
-        fields.update({
+    # Fields of a Facebook Post
+    facebook_fields = {
             'from':True,        
             'to':False,       
             'message':True,       
@@ -676,9 +1443,37 @@ class FcbPost(Base):
             'created_time':True,
             'updated_time':True,
             'shares':True,
-            'include_hidden':True,
+            'include_hidden':False, # A request parameter, not a field:
+                                    # Facebook rejects it in fields=
             'status_type':True,
-            })
+            }
+
+    def __init__(self, facebook_id, graph, facebook_table, **kwargs):
+        # Avoid direct instantiation
+        if type(self) == FcbPost:
+            raise TypeError, "FcbPost must be sublcassed"
+
+        fields = dict()
+        table_fields = dict()
+        references = dict()
+        connections = dict()
+
+        # Update attributes from subclasses
+        if 'fields' in kwargs:
+            fields.update(kwargs['fields'])
+            pass
+        if 'table_fields' in kwargs:
+            table_fields.update(kwargs['table_fields'])
+            pass
+        if 'references' in kwargs:
+            references.update(kwargs['references'])
+            pass
+        if 'connections' in kwargs:
+            references.update(kwargs['connections'])
+            pass
+
+        # Fields of the class override the ones of the subclasses
+        fields.update(FcbPost.facebook_fields)
 
         # Update the list of table_fields
 
@@ -779,19 +1574,61 @@ class FcbGroupPost(FcbPost):
         return record_id
 
   
+class FcbGroupComment(FcbPost):
+    """
+        Post sent to a group page
+    """
+
+    def __init__(self, facebook_id, graph, facebook_table='group_comment'):
+        # Update the list of references
+        # references are not updated because this attribute defines which
+        # facebook fields refer to an object to be created.
+        # 
+        #references = {
+        #        'facebook_group': False,    # This references a facebook
+        #                                    # group to which this post is
+        #                                    # tied to. False means that
+        #                                    # this attribute is not a list
+        #                                    # of references
+        #        }
+        super(FcbGroupPost, self).__init__(facebook_id, graph,
+                facebook_table=facebook_table, )
+
+        self.table_columns = [
+                'facebook_group_post',
+                ]
+
+    def db_update(self, facebook_group):
+        # A post has a reference to either a group or an event, in the
+        # framework of this work. In other words, a post is an item of the
+        # feed which is a list of posts. In our framework only events and
+        # groups have a feed. So we have to mention which object we are
+        # refering to. The subclass, when instantiated, will define the
+        # parent object and its ID which will be used here
+
+        record_id = super(FcbGroupPost,
+                self).db_update(facebook_group_post=facebook_group_post)
+        return record_id
+
+  
+
 class FcbGroup(Base):
+    media_fields = ('icon', 'cover')
+
+    # Fields of a Facebook Group
+    facebook_fields = {
+        'icon':True,        # The URL for the group's icon, string
+        'cover':True,       # Array containing a valid URL, cover_id and image offset. Just the url is kept
+        'owner':True,       # The profile that created this group, string
+        'description':True, # A brief description of the group, string
+        'link': True,       # The URL for the group's website, string
+        'privacy':True,     # The privacy setting of the group
+        'updated_time':True,# The last time the group was updated
+        }
+
     def __init__(self, facebook_id, graph, facebook_table='group'):
 
-        # Update the list of fields for Facebook Group
-        fields = {
-            'icon':True,        # The URL for the group's icon, string
-            'cover':True,       # Array containing a valid URL, cover_id and image offset. Just the url is kept
-            'owner':True,       # The profile that created this group, string
-            'description':True, # A brief description of the group, string
-            'link': True,       # The URL for the group's website, string
-            'privacy':True,     # The privacy setting of the group
-            'updated_time':True,# The last time the group was updated
-            }
+        fields = dict(FcbGroup.facebook_fields)
 
         # Update the list of references
         references = {          # True if attribute.type = list:reference
@@ -828,30 +1665,203 @@ class FcbGroup(Base):
         super(FcbGroup, self).update(self.facebook_object, *args, **kwargs)
 
 
-    def get_members(self):
-        self.members = members = self.get_connection('members')
+    def get_members(self, full=False):
+        """
+            Get the members who joined the group since the last
+            set_members, all of them if full is True. See
+            Base.sync_connection
+        """
+        self.members = members = self.sync_connection('members', full=full)
         
         return members
 
-    def set_members(self):
+    def set_members(self, commit=True):
+        """
+            Store the members read by get_members and save their watermark.
+            With commit=False the changes are not committed and the
+            watermark is left pending: the caller commits the database,
+            then calls self.commit_watermark('members')
+        """
         assert hasattr(self, 'members'), "Call self.get_members first"
 
-        for _member in self.members:
-            member = FcbUser(_member['id'], self.graph)
-            member.db_update()
+        context.new_session()
+        members = []
+        for index, _member in enumerate(self.members):
+            # Members already met as authors are not built again
+            member = Base.factory('user', _member['id'], self.graph)
+            if index % self.prefetch_size == 0:
+                # The first member of each slice fetches the next ones
+                member.prefetch([_next['id'] for _next in
+                        self.members[index + 1:index + self.prefetch_size]])
+                pass
+            members.append(member)
+            if len(members) == self.prefetch_size:
+                # Members are stored by slices, see Base.bulk_upsert
+                Base.bulk_upsert(members, commit=commit)
+                members = []
+                pass
+            pass
+        Base.bulk_upsert(members, commit=commit)
+        if commit:
+            self.commit_watermark('members')
             pass
         pass
 
-    def get_feed(self):
-        self.feed = feed = self.get_connection('feed')
+    def get_feed(self, full=False):
+        """
+            Get the posts sent or commented since the last set_feed, the
+            whole feed if full is True. See Base.sync_connection.
+
+            The feed of a group is sorted by last activity, a comment
+            brings an old post back to the top, so it is read down to the
+            updated_time of its watermark
+        """
+        self.feed = feed = self.sync_connection('feed', full=full,
+                time_field='updated_time', fields='id,updated_time')
         return feed
 
-    def set_feed(self):
+    def backfill_feed(self, since=FACEBOOK_EPOCH, until=None, workers=4,
+            window_items=500, page_size=100, time_field='created_time'):
+        """
+            Get the whole feed of the group between since and until (unix
+            times, until defaults to now) by crawling time windows
+            concurrently instead of following a single cursor chain.
+
+            The first page of each window tells how dense the feed is in
+            that window. If the rest of the window is expected to hold more
+            than window_items posts, it is split in smaller windows which
+            are crawled by other workers. Posts are merged and deduplicated
+            by id, the most recent first.
+
+            Like get_feed, the result is kept in self.feed for set_feed. Its
+            watermark is only set if the feed was read up to now: if a
+            window could not be read to its end, the posts read are kept
+            but get_feed will read the feed again
+        """
+        since = int(since)
+        up_to_now = until is None
+        until = int(until or time.time())
+        # updated_time gives the watermark of get_feed
+        fields = ','.join(set(['id', time_field, 'updated_time']))
+
+        def fetch(url):
+            return self.get(self.graph.get_page, url, cache_kind='feed')
+
+        def crawl(window):
+            # Returns the posts of the window, the windows split from it
+            # and whether the window was read to its end (or split)
+            window_since, window_until = window
+            paginator = facebook.Paginator(self.graph,
+                    self.facebook_id + '/feed', {
+                        'since': window_since,
+                        'until': window_until,
+                        'limit': page_size,
+                        'fields': fields,
+                        }, cache_kind='feed', fetch=fetch, prefetch=0)
+            posts = []
+            windows = []
+            for page, url in paginator:
+                posts.extend(page)
+                if windows or paginator.pages_read > 1 or not url:
+                    continue
+                # First page of the window: estimate the density of the
+                # rest of it from the time span of this page
+                times = [facebook._timestamp(post[time_field])
+                        for post in page if post.get(time_field)]
+                if not times:
+                    continue
+                oldest = min(times)
+                density = len(page) / float(max(1, window_until - oldest))
+                expected = density * (oldest - window_since)
+                # since and until are inclusive whole seconds: a window
+                # is split in at most one window per second, a window of
+                # one second follows its cursor
+                seconds = window_until - window_since + 1
+                count = int(min(expected / window_items, workers * 4)) + 1
+                count = min(count, seconds)
+                if expected > window_items and count > 1:
+                    bounds = [window_since + seconds * i // count
+                            for i in range(count + 1)]
+                    windows = [(bounds[i], bounds[i + 1] - 1)
+                            for i in range(count)]
+                    # The feed is sorted by last activity, posts created
+                    # after the oldest one of this page may be on the next
+                    # pages: the split windows cover the whole window
+                    break
+                pass
+            return posts, windows, paginator.complete or bool(windows)
+
+        # Crawl windows as workers become available, merging posts by id
+        feed = dict()
+        done = Queue.Queue()
+        pool = facebook.WorkerPool(workers)
+        pending = 0
+        windows = [(since, until)]
+        complete = True
+        try:
+            while windows or pending:
+                for window in windows:
+                    pool.submit(crawl, window).add_done_callback(done.put)
+                    pending += 1
+                    pass
+                future = done.get()
+                pending -= 1
+                posts, windows, window_complete = future.result()
+                complete = complete and window_complete
+                for post in posts:
+                    feed[post['id']] = post
+                    pass
+                pass
+        finally:
+            pool.shutdown(wait=False)
+
+        self.feed = sorted(feed.values(), reverse=True,
+                key=lambda post: facebook._timestamp(post.get(time_field, 0)))
+        if up_to_now and not complete:
+            # Base.get gave up on a page: a watermark would skip the posts
+            # of the rest of that window
+            logging.warning('The feed of %s was not read to its end, its '
+                    'watermark is kept' % self.facebook_id)
+            getattr(self, 'pending_watermarks', dict()).pop('feed', None)
+            pass
+        elif up_to_now:
+            # The whole feed up to now has been read, set_feed saves its
+            # watermark for get_feed
+            self.pending_watermark('feed', sorted(self.feed, reverse=True,
+                    key=lambda post: facebook._timestamp(
+                        post.get('updated_time', 0))), 'updated_time')
+            pass
+        return self.feed
+
+    def set_feed(self, commit=True):
+        """
+            Store the posts read by get_feed or backfill_feed and save
+            their watermark. commit is the same as for set_members
+        """
         assert hasattr(self, 'feed'), "Call self.get_feed first"
 
-        for _post in self.feed:
+        context.new_session()
+        posts = []
+        for index, _post in enumerate(self.feed):
             post = FcbGroupPost(_post['id'], self.graph)
-            post.db_update(self.facebook_id)
+            if index % self.prefetch_size == 0:
+                # The first post of each slice fetches the next ones and
+                # the objects they reference
+                post.prefetch([_next['id'] for _next in
+                        self.feed[index + 1:index + self.prefetch_size]])
+                pass
+            posts.append(post)
+            if len(posts) == self.prefetch_size:
+                # Posts are stored by slices, with their authors, see
+                # Base.bulk_upsert
+                Base.bulk_upsert(posts, commit=commit,
+                        facebook_group=self.facebook_id)
+                posts = []
+                pass
+            pass
+        Base.bulk_upsert(posts, commit=commit, facebook_group=self.facebook_id)
+        if commit:
+            self.commit_watermark('feed')
             pass
         pass
 
@@ -874,9 +1884,10 @@ def main():
     # Set facebook_group_id
     facebook_group_id = '335662792434'
 
-    # Get access token from facebook
+    # Get access token from facebook, or from the FACEBOOK_ACCESS_TOKEN
+    # environment variable
 
-    graph = facebook.GraphAPI(access_token)
+    graph = context.graph()
     group = FcbGroup(facebook_group_id, graph)
 
     # Update group information and data. If there is no data in the database, then
@@ -0,0 +1,520 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""A local stand-in for graph.facebook.com.
+
+The simulator serves synthetic groups, with their members, feed and
+comments, the way the Graph API does: field projection, metadata=1,
+?ids= lookups, cursor paging, batch requests and token exchange. It can
+slow the answers down and inject throttling errors (codes 4 and 17) and
+expired tokens (code 190, subcode 463) to exercise the retry, rate
+limiting and token refresh code paths without spending any quota:
+
+    simulator = Simulator(Dataset(members=1000, posts=5000), latency=0.05)
+    simulator.start()
+    graph = simulator.graph("token")
+    group = graphapi.FcbGroup(simulator.dataset.group_id(0), graph)
+    ...
+    simulator.stop()
+
+It can also be run on its own, see main().
+
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import base64
+import gzip
+import json
+import random
+import threading
+import time
+import urllib
+from StringIO import StringIO
+from urlparse import urlsplit, urlunsplit, parse_qsl
+
+import facebook
+
+
+def _iso_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%S+0000", time.gmtime(timestamp))
+
+
+class Dataset(object):
+    """Synthetic Graph API objects, generated on demand from their ids.
+
+    Every group has the same members (users 0 to members - 1) and its own
+    posts, one every interval seconds from start, each post having
+    comments comments. Nothing is held in memory, so that large crawls
+    can be simulated, except activity: {post index: unix time}, the posts
+    which were commented later on, like Facebook bumps them.
+
+    """
+    GROUP_BASE = 300000000000
+    USER_BASE = 100000000000000
+    POST_BASE = 10000000000
+
+    def __init__(self, groups=1, members=100, posts=100, comments=5,
+                 start=1300000000, interval=3600):
+        self.groups = groups
+        self.members = members
+        self.posts = posts
+        self.comments = comments
+        self.start = start
+        self.interval = interval
+        self.activity = {}
+
+    def group_id(self, index):
+        return str(self.GROUP_BASE + index)
+
+    def user_id(self, index):
+        return str(self.USER_BASE + index)
+
+    def post_id(self, group, index):
+        return "%s_%d" % (self.group_id(group), self.POST_BASE + index)
+
+    def parse_id(self, id):
+        """Returns (type, indexes) of an object id, or (None, None)."""
+        try:
+            parts = [int(part) for part in id.split("_")]
+        except ValueError:
+            return None, None
+        if len(parts) == 1:
+            if 0 <= parts[0] - self.USER_BASE < self.members:
+                return "user", (parts[0] - self.USER_BASE,)
+            if 0 <= parts[0] - self.GROUP_BASE < self.groups:
+                return "group", (parts[0] - self.GROUP_BASE,)
+        elif len(parts) in (2, 3):
+            group = parts[0] - self.GROUP_BASE
+            post = parts[1] - self.POST_BASE
+            if 0 <= group < self.groups and 0 <= post < self.posts:
+                if len(parts) == 2:
+                    return "post", (group, post)
+                if 0 <= parts[2] < self.comments:
+                    return "comment", (group, post, parts[2])
+        return None, None
+
+    def post_time(self, index):
+        return self.start + index * self.interval
+
+    def post_updated_time(self, index):
+        return max(self.post_time(index) + self.interval / 2,
+                   self.activity.get(index, 0))
+
+    def _profile(self, index):
+        return {"id": self.user_id(index), "name": "User %d" % index}
+
+    def user(self, index):
+        return {
+            "id": self.user_id(index),
+            "name": "User %d" % index,
+            "first_name": "User",
+            "last_name": str(index),
+            "gender": ("female", "male")[index % 2],
+            "username": "user.%d" % index,
+            "link": "https://www.facebook.com/user.%d" % index,
+            "locale": "en_US",
+            "updated_time": _iso_time(self.start),
+        }
+
+    def group(self, index):
+        id = self.group_id(index)
+        return {
+            "id": id,
+            "name": "Group %d" % index,
+            "icon": "https://static.example.com/icon.png",
+            "cover": {
+                "cover_id": id + "1",
+                "source": "https://static.example.com/cover.jpg",
+                "offset_y": 0,
+            },
+            "owner": self._profile(0),
+            "description": "Synthetic group %d" % index,
+            "link": "https://www.facebook.com/groups/%s/" % id,
+            "privacy": "OPEN",
+            "updated_time": _iso_time(self.post_time(self.posts)),
+        }
+
+    def post(self, group, index):
+        created = self.post_time(index)
+        return {
+            "id": self.post_id(group, index),
+            "from": self._profile(index % self.members),
+            "to": {"data": [{"id": self.group_id(group),
+                             "name": "Group %d" % group}]},
+            "message": "Post %d of group %d" % (index, group),
+            "type": "status",
+            "status_type": "mobile_status_update",
+            "created_time": _iso_time(created),
+            "updated_time": _iso_time(self.post_updated_time(index)),
+        }
+
+    def comment(self, group, post, index):
+        created = self.post_time(post) + index + 1
+        return {
+            "id": "%s_%d" % (self.post_id(group, post), index),
+            "from": self._profile((post + index + 1) % self.members),
+            "message": "Comment %d" % index,
+            "created_time": _iso_time(created),
+            "updated_time": _iso_time(created),
+            "comment_count": 0,
+        }
+
+    def get(self, id):
+        """Returns (type, object) for an id, or (None, None)."""
+        type, indexes = self.parse_id(id)
+        if type is None:
+            return None, None
+        return type, getattr(self, type)(*indexes)
+
+    def member(self, index):
+        return dict(self._profile(index), administrator=index == 0)
+
+    def connection(self, id, name, since=None, until=None):
+        """Returns (type, indexes) of the items of a connection.
+
+        Items are built from their indexes by the method named type, so
+        that only the requested page is generated. Members are sorted from
+        the last one who joined. Feeds are sorted from the last updated
+        post, and filtered on their creation time like Facebook does with
+        since and until. Returns (None, None) if there is no such
+        connection.
+
+        """
+        type, indexes = self.parse_id(id)
+        if type == "group" and name == "members":
+            return "member", [(index,)
+                              for index in range(self.members - 1, -1, -1)]
+        if type == "group" and name == "feed":
+            posts = range(self.posts - 1, -1, -1)
+            if since is not None:
+                posts = [index for index in posts
+                         if self.post_time(index) >= since]
+            if until is not None:
+                posts = [index for index in posts
+                         if self.post_time(index) <= until]
+            posts.sort(key=self.post_updated_time, reverse=True)
+            return "post", [(indexes[0], index) for index in posts]
+        if type == "post" and name == "comments":
+            return "comment", [indexes + (index,)
+                               for index in range(self.comments)]
+        return None, None
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are sent separately: without TCP_NODELAY each
+    # keep-alive request would wait for the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle()
+
+    def do_POST(self):
+        self._handle()
+
+    def do_DELETE(self):
+        self._handle()
+
+    def _handle(self):
+        parts = urlsplit(self.path)
+        args = dict(parse_qsl(parts.query, keep_blank_values=True))
+        length = int(self.headers.getheader("content-length") or 0)
+        if length:
+            args.update(parse_qsl(self.rfile.read(length),
+                                  keep_blank_values=True))
+        status, headers, body = self.server.simulator.handle(
+            self.command, parts.path, args)
+        if ("gzip" in (self.headers.getheader("accept-encoding") or "") and
+                self.server.simulator.compress):
+            buffer = StringIO()
+            with gzip.GzipFile(fileobj=buffer, mode="wb") as file:
+                file.write(body)
+            body = buffer.getvalue()
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SimulatorPool(facebook.ConnectionPool):
+    """A ConnectionPool sending Facebook's requests to a Simulator."""
+    HOSTS = ("graph.facebook.com", "api.facebook.com")
+
+    def __init__(self, address, **kwargs):
+        super(SimulatorPool, self).__init__(**kwargs)
+        self.address = address
+
+    def urlopen(self, method, url, *args, **kwargs):
+        parts = urlsplit(url)
+        if parts.hostname in self.HOSTS:
+            url = urlunsplit(("http", "%s:%d" % self.address, parts.path,
+                              parts.query, ""))
+        return super(SimulatorPool, self).urlopen(method, url, *args,
+                                                  **kwargs)
+
+
+class Simulator(object):
+    """Serves a Dataset over HTTP like graph.facebook.com.
+
+    Answers wait latency seconds, give or take jitter times latency.
+    throttle_rate is the probability that a request fails with a
+    throttling error (code 4 or 17). If token_lifetime is set, tokens
+    expire (code 190, subcode 463) after that many requests, until they
+    are exchanged for new ones at /oauth/access_token. Pages hold limit
+    items, 25 by default like Facebook.
+
+    """
+    def __init__(self, dataset=None, host="127.0.0.1", port=0, latency=0.0,
+                 jitter=0.5, throttle_rate=0.0, token_lifetime=None,
+                 compress=True, seed=None):
+        self.dataset = dataset or Dataset()
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_rate = throttle_rate
+        self.token_lifetime = token_lifetime
+        self.compress = compress
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "throttled": 0, "expired": 0,
+                      "tokens": 0}
+        self._token_uses = {}
+        self._lock = threading.Lock()
+        self._server = _Server((host, port), _Handler)
+        self._server.simulator = self
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._server.server_address[:2]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def pool(self, **kwargs):
+        """Returns a ConnectionPool whose requests reach this simulator."""
+        return SimulatorPool(self.address, **kwargs)
+
+    def graph(self, access_token="simulator", **kwargs):
+        """Returns a GraphAPI client talking to this simulator."""
+        kwargs.setdefault("transport", self.pool())
+        return facebook.GraphAPI(access_token, **kwargs)
+
+    def statistics(self):
+        with self._lock:
+            return dict(self.stats)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def _error(code, message, type="OAuthException", subcode=None):
+        error = {"message": message, "type": type, "code": code}
+        if subcode is not None:
+            error["error_subcode"] = subcode
+        return 400, {"error": error}
+
+    def _check(self, args):
+        """Returns an error response if the request should fail."""
+        if self.throttle_rate and self.random.random() < self.throttle_rate:
+            self._count("throttled")
+            code = self.random.choice((4, 17))
+            return self._error(code, "(#%d) Application request limit "
+                               "reached" % code)
+        token = args.get("access_token")
+        if self.token_lifetime and token:
+            with self._lock:
+                uses = self._token_uses.get(token, 0) + 1
+                self._token_uses[token] = uses
+            if uses > self.token_lifetime:
+                self._count("expired")
+                return self._error(190, "Error validating access token: "
+                                   "Session has expired", subcode=463)
+        return None
+
+    def handle(self, method, path, args):
+        """Returns (status, headers, body) for a request."""
+        self._count("requests")
+        if self.latency:
+            time.sleep(max(0.0, self.latency * (
+                1 + self.random.uniform(-self.jitter, self.jitter))))
+        path = path.strip("/")
+        if path == "oauth/access_token":
+            self._count("tokens")
+            with self._lock:
+                token = "simulator-%d" % self.stats["tokens"]
+            return 200, {"Content-Type": "text/plain"}, urllib.urlencode(
+                {"access_token": token, "expires": 5183999})
+
+        status, response = self._check(args) or self.respond(method, path,
+                                                            args)
+        return (status, {"Content-Type": "text/javascript; charset=UTF-8"},
+                json.dumps(response))
+
+    def respond(self, method, path, args):
+        """Returns (status, response) for a Graph API call."""
+        dataset = self.dataset
+        if path == "debug_token":
+            return 200, {"data": {
+                "is_valid": True,
+                "app_id": "simulator",
+                "expires_at": int(time.time()) + 3600,
+                "scopes": [],
+            }}
+        if method == "POST" and path == "" and "batch" in args:
+            return 200, self._batch(args)
+        if method != "GET":
+            # Writes are acknowledged but not stored
+            if "/" in path:
+                return 200, {"id": "%s_%d" % (path.split("/")[0],
+                                              self.random.getrandbits(32))}
+            return 200, {"success": True}
+        if path == "" and "ids" in args:
+            objects = {}
+            for id in args["ids"].split(","):
+                type, object = dataset.get(id)
+                if object is None:
+                    return self._unknown(id)
+                objects[id] = self._project(type, object, args)
+            return 200, objects
+
+        parts = path.split("/")
+        if len(parts) == 1:
+            type, object = dataset.get(parts[0])
+            if object is None:
+                return self._unknown(parts[0])
+            return 200, self._project(type, object, args)
+        if len(parts) == 2:
+            since = facebook._timestamp(args["since"]) \
+                if "since" in args else None
+            until = facebook._timestamp(args["until"]) \
+                if "until" in args else None
+            type, items = dataset.connection(parts[0], parts[1], since,
+                                             until)
+            if type is None:
+                return self._unknown(path)
+            return 200, self._page(path, getattr(dataset, type), items,
+                                   args)
+        return self._unknown(path)
+
+    def _unknown(self, id):
+        return self._error(803, "(#803) Some of the aliases you requested "
+                           "do not exist: %s" % id)
+
+    def _project(self, type, object, args):
+        if args.get("fields"):
+            fields = set(args["fields"].split(",")) | set(["id"])
+            object = dict((name, value) for name, value in object.items()
+                          if name in fields)
+        if type is not None and args.get("metadata") == "1":
+            object["metadata"] = {"type": type}
+        return object
+
+    def _page(self, path, build, items, args):
+        limit = int(args.get("limit") or 25)
+        offset = 0
+        if args.get("after"):
+            offset = int(base64.urlsafe_b64decode(str(args["after"])))
+        data = [self._project(None, build(*indexes), args)
+                for indexes in items[offset:offset + limit]]
+        response = {"data": data}
+        if data:
+            cursor = lambda index: base64.urlsafe_b64encode(str(index))
+            response["paging"] = {"cursors": {
+                "before": cursor(offset),
+                "after": cursor(offset + len(data)),
+            }}
+            if offset + len(data) < len(items):
+                next_args = dict(args, limit=limit,
+                                 after=cursor(offset + len(data)))
+                response["paging"]["next"] = (
+                    "https://graph.facebook.com/%s?%s" %
+                    (path, urllib.urlencode(next_args)))
+        return response
+
+    def _batch(self, args):
+        results = []
+        for operation in json.loads(args["batch"]):
+            parts = urlsplit("/" + operation["relative_url"].lstrip("/"))
+            operation_args = dict(parse_qsl(parts.query,
+                                            keep_blank_values=True))
+            operation_args.update(parse_qsl(operation.get("body", ""),
+                                            keep_blank_values=True))
+            status, response = self._check(dict(
+                operation_args, access_token=args.get("access_token"))) \
+                or self.respond(operation["method"], parts.path.strip("/"),
+                                operation_args)
+            results.append({"code": status, "headers": [],
+                            "body": json.dumps(response)})
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serves synthetic groups like graph.facebook.com")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--groups", type=int, default=1)
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=100)
+    parser.add_argument("--comments", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.5)
+    parser.add_argument("--throttle-rate", type=float, default=0.0)
+    parser.add_argument("--token-lifetime", type=int, default=None)
+    options = parser.parse_args()
+
+    dataset = Dataset(options.groups, options.members, options.posts,
+                      options.comments)
+    simulator = Simulator(dataset, options.host, options.port,
+                          options.latency, options.jitter,
+                          options.throttle_rate, options.token_lifetime)
+    print "Serving %d group(s) on http://%s:%d/, first group id %s" % (
+        dataset.groups, options.host, simulator.address[1],
+        dataset.group_id(0))
+    try:
+        simulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()